@@ -0,0 +1,134 @@
+# NHC Cones - pipeline benchmarks
+# Times each stage of the pipeline separately against the checked-in fixtures in benchmarks/fixtures,
+# without hitting nhc.noaa.gov
+#
+# Usage: python benchmarks/bench_pipeline.py [--repeat N] [--json report.json] [--verbose]
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import main  # noqa: E402
+import nhc_fixtures  # noqa: E402
+from PIL import Image  # noqa: E402
+
+
+class StageTimer:
+    def __init__(self, repeat, verbose):
+        self.repeat = repeat
+        self.verbose = verbose
+        self.results = {}
+
+    # Runs func repeat times, setup (untimed) before each run, and keeps the per-run durations in seconds
+    def time(self, stage, func, setup=None):
+        durations = []
+        result = None
+        for _ in range(self.repeat):
+            arg = setup() if setup is not None else None
+            output = io.StringIO()
+            with contextlib.redirect_stdout(sys.stdout if self.verbose else output):
+                start = time.perf_counter()
+                result = func(arg) if setup is not None else func()
+                durations.append(time.perf_counter() - start)
+        self.results[stage] = durations
+        return result
+
+    def report(self):
+        width = max(len(stage) for stage in self.results)
+        print(f"{'stage'.ljust(width)}  {'min ms':>10}  {'median ms':>10}")
+        for stage, durations in self.results.items():
+            print(f"{stage.ljust(width)}  {min(durations) * 1000:10.2f}  {statistics.median(durations) * 1000:10.2f}")
+
+    def as_dict(self):
+        return {stage: {'min_s': min(durations), 'median_s': statistics.median(durations), 'runs_s': durations}
+                for stage, durations in self.results.items()}
+
+
+def get_cone_lon_lat(storm_cache):
+    lons = []
+    lats = []
+    for storm, storm_model in sorted(storm_cache.items()):
+        if storm_model.has_cone():
+            lons += storm_model.coords[:, 0].tolist()
+            lats += storm_model.coords[:, 1].tolist()
+    return lons, lats
+
+
+def run_benchmarks(repeat, verbose):
+    timer = StageTimer(repeat, verbose)
+    main.useHttpCache = False
+    nhc_fixtures.mount_fixtures(main)
+    work_dir = tempfile.mkdtemp(prefix='nhc-cones-bench-')
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        def clear_work_dir():
+            for file in os.listdir(work_dir):
+                os.remove(file)
+
+        def scrape(_):
+            urls = [url for url in main.get_basin_urls(main.get_basins()) if url.endswith('.kmz')]
+            return main.fetch_files(urls)
+        kmz_files = timer.time('scrape', scrape, setup=clear_work_dir)
+        kmz_files = [file for file in kmz_files if file.endswith('.kmz')]
+
+        timer.time('kmz_to_kml', lambda: [main.kmz_to_kml(file) for file in kmz_files])
+        cone_kml_files = [file.replace('.kmz', '.kml') for file in kmz_files if '_CONE_' in file]
+        timer.time('extract_coords_from_kml', lambda: [main.extract_coords_from_kml(file) for file in cone_kml_files])
+        cone_kmz_files = [file for file in kmz_files if '_CONE_' in file]
+        timer.time('extract_cone_rings_from_kmz', lambda: [main.extract_cone_rings_from_kmz(file)
+                                                            for file in cone_kmz_files])
+        timer.time('stream_cone_rings_from_kmz', lambda: [main.stream_cone_rings_from_kmz(file)
+                                                           for file in cone_kmz_files])
+        # Start every run with an empty parse cache, so each one parses the products
+        def clear_parse_cache():
+            main.PARSED_PRODUCT_CACHE = {}
+        storm_cache = timer.time('build_storm_cache', lambda _: main.build_storm_cache(kmz_files),
+                                 setup=clear_parse_cache)
+
+        lons, lats = get_cone_lon_lat(storm_cache)
+        for basin in main.get_basins():
+            name = basin['name']
+            lat_func, long_func, lat_batch_func, long_batch_func, viewport = main.get_basin_projections(basin)
+            timer.time(f'projection[{name}] scalar',
+                       lambda: [(long_func(lon), lat_func(lat)) for lon, lat in zip(lons, lats)])
+            timer.time(f'projection[{name}] batch', lambda: (long_batch_func(lons), lat_batch_func(lats)))
+
+        for basin in main.get_basins():
+            name = basin['name']
+            lat_func, long_func, lat_batch_func, long_batch_func, viewport = main.get_basin_projections(basin)
+            with Image.open(path.join(nhc_fixtures.FIXTURES_DIR, basin['base_image_file'])) as base:
+                base_rgb = base.convert('RGB')
+            rendered = timer.time(f'modify_image[{name}]',
+                                  lambda image: main.modify_image(image, lat_func, long_func, storm_cache,
+                                                                  lat_batch_func, long_batch_func, viewport) or image,
+                                  setup=base_rgb.copy)
+            timer.time(f'png save[{name}]', lambda: rendered.save(io.BytesIO(), format='PNG'))
+    finally:
+        os.chdir(cwd)
+        for file in os.listdir(work_dir):
+            os.remove(path.join(work_dir, file))
+        os.rmdir(work_dir)
+    return timer
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time each pipeline stage against the offline NHC fixtures')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per stage (default 5)')
+    parser.add_argument('--json', help='Also write the timings to this JSON file')
+    parser.add_argument('--verbose', action='store_true', help="Show the pipeline's own output")
+    args = parser.parse_args()
+    stage_timer = run_benchmarks(max(1, args.repeat), args.verbose)
+    stage_timer.report()
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(stage_timer.as_dict(), out, indent=2)
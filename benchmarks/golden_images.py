@@ -0,0 +1,139 @@
+# NHC Cones - golden image check
+# Renders the fixture storms on every basin through the reference path (scalar projection, one putpixel per vertex)
+# and through each alternative engine, and reports how many pixels the engine moved, so faster drawing and projection
+# modes can be checked offline before they are switched on
+#
+# Usage: python benchmarks/golden_images.py [--engine batch] [--tolerance PIXELS] [--basin-tolerance atl=PIXELS]
+#                                           [--save-dir DIR] [--json report.json] [--verbose]
+# Exits with status 1 if any basin is over its tolerance
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import main  # noqa: E402
+import nhc_fixtures  # noqa: E402
+import numpy as np  # noqa: E402
+from PIL import Image, ImageDraw  # noqa: E402
+
+# The render settings every render starts from, the reference path is these as they are
+REFERENCE_SETTINGS = {'useBatchProjection': False, 'drawOnExtents': False, 'coneOutlineStyle': 'dotted'}
+# Each alternative engine, as the render settings it changes
+# 'line' and 'filled' change the look on purpose, so they only pass with a tolerance to match
+ENGINES = {
+    'batch': {'useBatchProjection': True},
+    'line': {'useBatchProjection': True, 'coneOutlineStyle': 'line'},
+    'filled': {'useBatchProjection': True, 'coneOutlineStyle': 'filled'},
+}
+DIFF_COLOR = (255, 0, 0)
+
+
+# Renders the storms on one basin's fixture base image with the given render settings
+def render_fixture_basin(basin, storm_cache, settings, verbose):
+    main.apply_render_settings(dict(main.get_render_settings(), **settings))
+    with Image.open(path.join(nhc_fixtures.FIXTURES_DIR, basin['base_image_file'])) as base:
+        image = base.convert('RGB')
+    lat_func, long_func, lat_batch_func, long_batch_func, viewport = main.get_basin_projections(basin)
+    with contextlib.redirect_stdout(sys.stdout if verbose else io.StringIO()):
+        main.remove_logos_and_add_unofficial_text(ImageDraw.Draw(image), basin['text_locations'])
+        main.modify_image(image, lat_func, long_func, storm_cache, lat_batch_func, long_batch_func, viewport,
+                          basin['name'])
+    return image
+
+
+# Compares two renders of the same basin
+# Returns (differing pixel count, largest channel difference, bounding box of the differences or None, diff mask)
+def compare_renders(reference, candidate):
+    reference_pixels = np.asarray(reference, dtype=np.int16)
+    candidate_pixels = np.asarray(candidate, dtype=np.int16)
+    delta = np.abs(reference_pixels - candidate_pixels).max(axis=2)
+    mask = delta > 0
+    if not mask.any():
+        return 0, 0, None, mask
+    rows = np.flatnonzero(mask.any(axis=1))
+    columns = np.flatnonzero(mask.any(axis=0))
+    bbox = (int(columns[0]), int(rows[0]), int(columns[-1]) + 1, int(rows[-1]) + 1)
+    return int(np.count_nonzero(mask)), int(delta.max()), bbox, mask
+
+
+# The reference render, greyed out, with every pixel the engine moved in DIFF_COLOR
+def get_diff_image(reference, mask):
+    diff_image = reference.convert('L').convert('RGB')
+    diff_image.paste(DIFF_COLOR, (0, 0) + diff_image.size, Image.fromarray(mask.astype(np.uint8) * 255, 'L'))
+    return diff_image
+
+
+def run_golden_check(engines, tolerance, basin_tolerances, save_dir, verbose):
+    main.useHttpCache = False
+    original_settings = main.get_render_settings()
+    with contextlib.redirect_stdout(sys.stdout if verbose else io.StringIO()):
+        storm_cache = main.build_storm_cache(nhc_fixtures.get_fixture_kmz_files())
+    if save_dir:
+        os.makedirs(save_dir, exist_ok=True)
+    results = []
+    try:
+        for basin in main.get_basins():
+            name = basin['name']
+            reference = render_fixture_basin(basin, storm_cache, REFERENCE_SETTINGS, verbose)
+            if save_dir:
+                reference.save(path.join(save_dir, f"{name}_reference.png"))
+            basin_tolerance = basin_tolerances.get(name, tolerance)
+            for engine in engines:
+                candidate = render_fixture_basin(basin, storm_cache, dict(REFERENCE_SETTINGS, **ENGINES[engine]),
+                                                 verbose)
+                diff_pixels, max_delta, bbox, mask = compare_renders(reference, candidate)
+                results.append({'basin': name, 'engine': engine, 'diff_pixels': diff_pixels,
+                                'diff_fraction': diff_pixels / mask.size, 'max_channel_delta': max_delta,
+                                'bbox': bbox, 'tolerance': basin_tolerance, 'passed': diff_pixels <= basin_tolerance})
+                if save_dir:
+                    candidate.save(path.join(save_dir, f"{name}_{engine}.png"))
+                    if diff_pixels:
+                        get_diff_image(reference, mask).save(path.join(save_dir, f"{name}_{engine}_diff.png"))
+    finally:
+        main.apply_render_settings(original_settings)
+    return results
+
+
+def report(results):
+    print(f"{'basin':<8}  {'engine':<8}  {'diff px':>9}  {'diff %':>8}  {'max delta':>9}  {'tolerance':>9}  result")
+    for result in results:
+        print(f"{result['basin']:<8}  {result['engine']:<8}  {result['diff_pixels']:>9}  "
+              f"{result['diff_fraction'] * 100:>8.4f}  {result['max_channel_delta']:>9}  {result['tolerance']:>9}  "
+              f"{'ok' if result['passed'] else 'FAIL'}" + (f"  bbox {result['bbox']}" if result['bbox'] else ''))
+
+
+# Parses a --basin-tolerance value, e.g. "atl=25"
+def parse_basin_tolerance(value):
+    name, _, pixels = value.partition('=')
+    try:
+        return name, int(pixels)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected NAME=PIXELS, got {value!r}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare the alternative render engines against the reference path '
+                                                 'on the offline NHC fixtures')
+    parser.add_argument('--engine', action='append', choices=sorted(ENGINES),
+                        help='Engine to check, can be repeated (default batch)')
+    parser.add_argument('--tolerance', type=int, default=0,
+                        help='Differing pixels allowed per basin (default 0)')
+    parser.add_argument('--basin-tolerance', action='append', type=parse_basin_tolerance, default=[],
+                        metavar='NAME=PIXELS', help="Overrides --tolerance for one basin, can be repeated")
+    parser.add_argument('--save-dir', help='Also write each reference, engine and diff image into this directory')
+    parser.add_argument('--json', help='Also write the results to this JSON file')
+    parser.add_argument('--verbose', action='store_true', help="Show the pipeline's own output")
+    args = parser.parse_args()
+    golden_results = run_golden_check(args.engine or ['batch'], args.tolerance, dict(args.basin_tolerance),
+                                      args.save_dir, args.verbose)
+    report(golden_results)
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(golden_results, out, indent=2)
+    sys.exit(0 if all(result['passed'] for result in golden_results) else 1)
@@ -0,0 +1,55 @@
+# NHC Cones - offline fixtures
+# Serves the checked-in fixture set in place of nhc.noaa.gov, through a requests transport adapter
+# mounted on main's shared session, so the real fetch code runs without touching the network
+
+import io
+import os.path
+from os import path
+from urllib.parse import urlparse
+from requests.adapters import BaseAdapter
+from requests.models import Response
+
+FIXTURES_DIR = path.join(path.dirname(path.abspath(__file__)), 'fixtures')
+# The GIS index page is saved under this name, everything else keeps its basename
+GIS_PAGE_FIXTURE = 'gis_index.html'
+NHC_HOST = 'https://www.nhc.noaa.gov'
+
+
+def get_fixture_name(url):
+    return path.basename(urlparse(url).path) or GIS_PAGE_FIXTURE
+
+
+class FixtureAdapter(BaseAdapter):
+    def __init__(self, fixtures_dir=FIXTURES_DIR):
+        super().__init__()
+        self.fixtures_dir = fixtures_dir
+        self.request_count = 0
+
+    def send(self, request, **kwargs):
+        self.request_count += 1
+        response = Response()
+        response.url = request.url
+        response.request = request
+        fixture_file = path.join(self.fixtures_dir, get_fixture_name(request.url))
+        if os.path.exists(fixture_file):
+            with open(fixture_file, 'rb') as fixture:
+                response.raw = io.BytesIO(fixture.read())
+            response.status_code = 200
+        else:
+            response.raw = io.BytesIO(b'')
+            response.status_code = 404
+        return response
+
+    def close(self):
+        pass
+
+
+# Points main's shared session at the fixtures, returns the adapter so callers can count requests
+def mount_fixtures(main_module, fixtures_dir=FIXTURES_DIR):
+    adapter = FixtureAdapter(fixtures_dir)
+    main_module.get_http_session().mount(NHC_HOST, adapter)
+    return adapter
+
+
+def get_fixture_kmz_files(fixtures_dir=FIXTURES_DIR):
+    return sorted(path.join(fixtures_dir, f) for f in os.listdir(fixtures_dir) if f.endswith('.kmz'))
@@ -0,0 +1,36 @@
+# NHC Cones - fixture recorder
+# Replaces benchmarks/fixtures with a snapshot of what nhc.noaa.gov is serving right now:
+# the /gis/ page, every CONE/TRACK kmz it links for the three basins, and the three base images
+# Best run on a busy multi-storm day
+#
+# Usage: python benchmarks/record_fixtures.py
+
+import os
+import sys
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import main  # noqa: E402
+import nhc_fixtures  # noqa: E402
+
+
+def record_fixtures(fixtures_dir=nhc_fixtures.FIXTURES_DIR):
+    main.useHttpCache = False
+    os.makedirs(fixtures_dir, exist_ok=True)
+    for file in os.listdir(fixtures_dir):
+        os.remove(path.join(fixtures_dir, file))
+    cwd = os.getcwd()
+    os.chdir(fixtures_dir)
+    try:
+        page_content, _ = main.fetch_url_content(main.GIS_PAGE_URL)
+        with open(nhc_fixtures.GIS_PAGE_FIXTURE, 'wb') as out:
+            out.write(page_content)
+        files = main.fetch_files(main.get_basin_urls(main.get_basins()))
+    finally:
+        os.chdir(cwd)
+    print(f"Recorded {len(files) + 1} fixtures into {fixtures_dir}")
+
+
+if __name__ == "__main__":
+    record_fixtures()
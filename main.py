@@ -7,38 +7,118 @@
 
 import glob
 import zipfile
-from xml.dom import minidom
 import re
-import urllib.request
-import requests
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+import threading
+import hashlib
+import json
+import time
+import contextlib
+import functools
+import random
+import argparse
+import io
 import os.path
 from os import path
-from urllib.parse import urlparse
-from PIL import Image, ImageFont, ImageDraw, ImageColor
+from urllib.parse import urlparse, urljoin
 import xml.etree.ElementTree as ET
-from lxml import html
 import datetime
-import pytz
 
 UNOFFICIAL_STRING = '!!UNOFFICIAL IMAGE!!'
-NHC_BASE_URL = 'https://www.nhc.noaa.gov'
-try:
-    DRAW_FONT = ImageFont.truetype('Pillow/Tests/fonts/FreeMono.ttf', 15)
-except:
-    print("Failed to load FreeMono.ttf, trying load_default()")
-    DRAW_FONT = ImageFont.load_default()
-DRAW_WHITE = ImageColor.getrgb('white')
-DRAW_BLACK = ImageColor.getrgb('black')
+# Loaded on first use by get_draw_font, so runs that never draw anything don't pay for it
+DRAW_FONT = None
+DRAW_WHITE = (255, 255, 255)
+DRAW_BLACK = (0, 0, 0)
 addDisclaimerText = True
 cleanUpFiles = True
-generateAtlantic = True
-generateCentralPacific = True
-generateEasternPacific = True
+# The basins to render: base image, projection control points, timezone and text positions for each one
+# Set "enabled": false on an entry to skip it, or add entries to render more products from the same fetch
+basinConfigFile = 'basins.json'
 # Controls whether or not the cones are drawn on each map, if there's overlap
 drawConesWhenTheyOverlapRegions = True
 # Controls whether or not pixels are drawn that are outside of the viewport
 # When drawing EPac on CPac, this will happen a lot
 drawOnExtents = False
+# Projects each cone as a whole array with NumPy, instead of one point at a time
+useBatchProjection = True
+# Reads the KMZ products with a single streaming iterparse pass, instead of building the whole tree
+useStreamingKmlParser = True
+# How cones are drawn when useBatchProjection is set:
+# 'dotted' plots each cone vertex (the original look), 'line' connects them, 'filled' also shades the inside
+coneOutlineStyle = 'dotted'
+coneOutlineWidth = 1
+coneFillColor = (255, 255, 255)
+# 0-255, how strongly the fill color covers the map
+coneFillOpacity = 64
+# PNG encoder settings for the outputs: compress_level 0-9 (6 is Pillow's default), optimize trades time for size
+pngCompressLevel = 6
+pngOptimize = False
+# Reduces each output to a palette of at most pngPaletteColors colors before saving, much smaller for these maps
+usePalettePng = False
+pngPaletteColors = 256
+# Also writes a WebP copy of each output next to it, e.g. atl_latest.webp
+writeWebpVariant = False
+webpLossless = True
+# 0-100, only used when webpLossless is False
+webpQuality = 80
+# Any of these can be overridden per basin with an "encoding" object in its registry entry, e.g. {"palette": true}
+# Also encodes each output with every ENCODING_OPTIONS entry (in memory), and reports the time and size of each
+reportEncodingOptions = False
+# Keeps the last loopFrameCount renders of each basin in loopDir, and writes them out as an animation next to the
+# output every time it's re-rendered, 'gif' (e.g. atl_latest_loop.gif) or 'apng' (atl_latest_loop.png)
+# Frames are shown for loopFrameDuration milliseconds, the newest one for loopLastFrameDuration
+writeLoopAnimation = False
+loopFormat = 'gif'
+loopFrameCount = 12
+loopDir = 'loops'
+loopFrameDuration = 500
+loopLastFrameDuration = 2000
+# Maximum number of concurrent downloads in the fetch stage
+fetchMaxWorkers = 8
+# Seconds to wait for a connection, and for each read from it
+fetchConnectTimeout = 5
+fetchReadTimeout = 20
+# Failed requests (connection errors, timeouts, 429 and 5xx responses) are retried this many times,
+# after fetchRetryDelay seconds, doubling for each retry
+fetchRetries = 3
+fetchRetryDelay = 1
+# Seconds a whole run may spend fetching, None for no limit
+# Anything that can't be fetched in time (or at all) falls back to the last good copy in the HTTP cache
+fetchDeadline = 120
+# Keeps every downloaded asset in a persistent, content-addressed cache, and revalidates it with
+# If-None-Match/If-Modified-Since, so an unchanged asset costs a 304 instead of a full download
+useHttpCache = True
+httpCacheDir = '.http_cache'
+# Also keeps each basin's prepared base layer (logos blanked, disclaimer text drawn) in httpCacheDir as a raw buffer,
+# so every process after the first starts from it instead of decoding and preparing the base image
+useBaseLayerDiskCache = True
+# Skips a basin's render when its base image, storm geometry and render settings are the same as the last render
+skipUnchangedRenders = True
+# Renders the basins in parallel worker processes (overlap mode only), each worker gets the already-parsed storms
+renderBasinsInProcessPool = False
+# None lets ProcessPoolExecutor use one worker per core
+renderMaxWorkers = None
+# Per-stage durations and counters for the run are written here at the end of main(), None to disable
+metricsReportFile = 'nhc_cones_metrics.json'
+# 'json', or 'prometheus' for a node_exporter textfile (use a .prom metricsReportFile)
+metricsFormat = 'json'
+# Daemon mode (--daemon): seconds between polls, +/- this fraction of random jitter,
+# and the retry delay after a failed poll, doubling on each consecutive failure up to daemonMaxBackoff
+daemonPollInterval = 900
+daemonJitter = 0.1
+daemonRetryDelay = 30
+daemonMaxBackoff = 3600
+# Serve mode (--serve): where to listen, and how long clients may cache an image
+serveBindAddress = '127.0.0.1'
+servePort = 8080
+serveMaxAge = 60
+# Archive mode (--archive): where the per-advisory maps go, how many hours a storm's last advisory stays on the map
+# when other storms advise, how many consecutive advisory times each worker task renders, and the worker count
+# (None for one per core)
+archiveOutputDir = 'archive_output'
+archiveMaxAdvisoryAge = 6
+archiveChunkSize = 8
+archiveMaxWorkers = None
 
 
 # Gets the namespace from an element
@@ -49,30 +129,53 @@ def get_namespace(element):
 
 def extract_coords_from_kml(file):
     print(f"extract_coords_from_kml: Reading file: {file}")
-    tree = ET.parse(file)
-    root = tree.getroot()
+    return extract_coords_from_root(ET.parse(file).getroot(), file)
+
+
+def extract_coords_from_root(root, file):
+    coords = []
+    for ring in extract_rings_from_root(root, file):
+        coords.extend(ring)
+    return coords
+
+
+def extract_cone_rings_from_kmz(file):
+    print(f"extract_cone_rings_from_kmz: Reading file: {file}")
+    return extract_rings_from_root(read_kml_root_from_kmz(file), file)
+
+
+# Same as extract_coords_from_root, but keeps each LinearRing's coordinates in its own list
+def extract_rings_from_root(root, file):
     namespace = get_namespace(root)
     # print(f"namespace is: {namespace}")
-    coords = []
+    rings = []
     for node in root.findall(f".//{namespace}LinearRing/{namespace}coordinates"):
         coord_text_split = node.text.strip().split()
-        for coord_text in coord_text_split:
-            coords.append(coord_text)
+        if coord_text_split:
+            rings.append(coord_text_split)
     # For processing TRACK data
     # for node in root.findall(".//{0}LineString/{0}coordinates".format(namespace)):
     #     coord_text_split = node.text.strip().split()
     #     for coord_text in coord_text_split:
     #         coords.append(coord_text)
-    if not coords:
+    if not rings:
         # Fall back to brute-force
         print(f"WARNING: Failed to get coords from {file}")
-        coords = root[0][3][1][0][0][0].text.strip().split()
-    return coords
+        rings = [root[0][3][1][0][0][0].text.strip().split()]
+    return rings
+
 
 def extract_speed_from_kml(file):
     print(f"extract_speed_from_kml: Reading file: {file}")
-    tree = ET.parse(file)
-    root = tree.getroot()
+    return extract_speed_from_root(ET.parse(file).getroot(), file)
+
+
+def extract_speed_from_kmz(file):
+    print(f"extract_speed_from_kmz: Reading file: {file}")
+    return extract_speed_from_root(read_kml_root_from_kmz(file), file)
+
+
+def extract_speed_from_root(root, file):
     namespace = get_namespace(root)
     # print(f"namespace is: {namespace}")
     got_coords = False
@@ -85,28 +188,9 @@ def extract_speed_from_kml(file):
         if node.get("name") == "TCInitLocation":
             value = node.find(f"./{namespace}value")
             if value is not None:
-
-                coord_text_split = value.text.strip().replace(",", "").split()
-                if len(coord_text_split) == 2:
-                    lat_val, lon_val = coord_text_split
-                    try:
-                        # First try to convert the value directly to a float
-                        lat_val = float(lat_val)
-                    except:
-                        # If an exception, then it's a string representation
-                        if lat_val.endswith("S"):
-                            lat_val = f"-{lat_val}"
-                        # Remove the last character (it's a N or S)
-                        lat_val = lat_val[:-1]
-                    try:
-                        # First try to convert the value directly to a float
-                        lon_val = float(lon_val)
-                    except:
-                        # If an exception, then it's a string representation
-                        if lon_val.endswith("W"):
-                            lon_val = f"-{lon_val}"
-                        # Remove the last character (it's a W or E)
-                        lon_val = lon_val[:-1]
+                init_location = parse_init_location(value.text)
+                if init_location is not None:
+                    lat_val, lon_val = init_location
                     got_coords = True
                     if got_speed:
                         break
@@ -129,39 +213,469 @@ def extract_speed_from_kml(file):
     return lat_val, lon_val, max_wind
 
 
-# Atlantic which_td = 2
-# Eastern Pacific which_td = 3
-# Central Pacific which_td = 4
-# convert_kmz_to_kml controls if we want to call kmz_to_kml in this function, or delay it, in the case we're going to overlap cones on all maps
-def scrape_page(which_td, convert_kmz_to_kml=True):
-    page = requests.get('https://www.nhc.noaa.gov/gis/')
-    content = page.content.decode('UTF-8')
-    tree = html.fromstring(content)
-    kmz_files = []
-    links = tree.xpath("/html/body/div[5]/div/table[1]/tr[3]/td[{}]/a".format(which_td))
-    for link in links:
-        if re.match(r'.*/\w+_CONE_latest.kmz', link.attrib['href']):
-            kmz_files.append(link.attrib['href'])
-        elif re.match(r'.*/\w+_TRACK_latest.kmz', link.attrib['href']):
-            kmz_files.append(link.attrib['href'])
-    for file_match in kmz_files:
-        full_url = "{}{}".format(NHC_BASE_URL, file_match.strip())
-        url = urlparse(full_url)
-        print("file: ", full_url)
-        file_name = path.basename(url.path)
-        if not (os.path.exists(file_name)):
-            urllib.request.urlretrieve(full_url, file_name)
-        else:
-            print("file ", file_name, " already downloaded")
-        if convert_kmz_to_kml:
-            kmz_to_kml(file_name)
+# Parses a TCInitLocation value, e.g. "25.3N, 70.2W", into (lat, lon)
+# Returns None if it isn't a lat/lon pair
+def parse_init_location(text):
+    coord_text_split = text.strip().replace(",", "").split()
+    if len(coord_text_split) != 2:
+        return None
+    lat_val, lon_val = coord_text_split
+    try:
+        # First try to convert the value directly to a float
+        lat_val = float(lat_val)
+    except:
+        # If an exception, then it's a string representation
+        if lat_val.endswith("S"):
+            lat_val = f"-{lat_val}"
+        # Remove the last character (it's a N or S)
+        lat_val = lat_val[:-1]
+    try:
+        # First try to convert the value directly to a float
+        lon_val = float(lon_val)
+    except:
+        # If an exception, then it's a string representation
+        if lon_val.endswith("W"):
+            lon_val = f"-{lon_val}"
+        # Remove the last character (it's a W or E)
+        lon_val = lon_val[:-1]
+    return lat_val, lon_val
+
+
+# Single streaming pass over a KML document, source is a file name or a file object
+# Collects the LinearRing coordinates (want_rings) and the TCInitLocation/maxWindMPH ExtendedData values (want_speed),
+# clearing elements as it goes so memory stays flat, and stops as soon as it has everything it was asked for
+# Returns (rings, (lat, lon, max wind)), the second part matching extract_speed_from_root
+def stream_extract_from_kml(source, want_rings=True, want_speed=True):
+    rings = []
+    got_coords = False
+    got_speed = False
+    lat_val = 0
+    lon_val = 0
+    max_wind = 0
+    # Local names of the currently open elements
+    open_tags = []
+    data_name = None
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        tag = elem.tag.rsplit('}', 1)[-1]
+        if event == 'start':
+            open_tags.append(tag)
+            if tag == 'Data':
+                data_name = elem.get('name')
+            continue
+        open_tags.pop()
+        if tag == 'coordinates' and want_rings and open_tags and open_tags[-1] == 'LinearRing':
+            coord_text_split = (elem.text or '').strip().split()
+            if coord_text_split:
+                rings.append(coord_text_split)
+        elif tag == 'value' and want_speed and open_tags[-2:] == ['ExtendedData', 'Data']:
+            if data_name == 'TCInitLocation' and not got_coords:
+                init_location = parse_init_location(elem.text or '')
+                if init_location is not None:
+                    lat_val, lon_val = init_location
+                    got_coords = True
+            elif data_name == 'maxWindMPH' and not got_speed:
+                max_wind = (elem.text or '').strip()
+                got_speed = True
+        elem.clear()
+        if not want_rings and got_coords and got_speed:
+            break
+    if not want_speed or (not got_coords and not got_speed):
+        return rings, (None, None, None)
+    return rings, (lat_val, lon_val, max_wind)
+
+
+# Streams the KML member of a KMZ through stream_extract_from_kml, without reading it into memory first
+def stream_extract_from_kmz(fname, want_rings=True, want_speed=True):
+    with zipfile.ZipFile(fname, 'r') as zf:
+        for fn in zf.namelist():
+            if fn.endswith('.kml'):
+                with zf.open(fn) as kml_stream:
+                    return stream_extract_from_kml(kml_stream, want_rings, want_speed)
+    raise ValueError(f"No .kml member found in {fname}")
+
+
+def stream_cone_rings_from_kmz(file):
+    print(f"stream_cone_rings_from_kmz: Reading file: {file}")
+    rings, _ = stream_extract_from_kmz(file, want_rings=True, want_speed=False)
+    if not rings:
+        # Let the tree based parser try its brute-force fallback
+        return extract_cone_rings_from_kmz(file)
+    return rings
+
+
+def stream_speed_from_kmz(file):
+    print(f"stream_speed_from_kmz: Reading file: {file}")
+    _, speed = stream_extract_from_kmz(file, want_rings=False, want_speed=True)
+    if speed[0] is None:
+        print("WARNING: Failed to get coords from ", file)
+    return speed
+
 
+# Per-run metrics: stage durations in seconds and counters, both keyed by (name, labels)
+# where labels is a sorted tuple of (label, value) pairs, e.g. ('png_encode', (('basin', 'atl'),))
+RUN_METRICS = {'stages': {}, 'counters': {}}
+METRICS_LOCK = threading.Lock()
 
-def get_latest_base_image(image_url):
-    url_parsed = urlparse(image_url)
-    file_name = path.basename(url_parsed.path)
-    if not (os.path.exists(file_name)):
-        urllib.request.urlretrieve(image_url, file_name)
+
+def get_metric_key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def reset_run_metrics():
+    with METRICS_LOCK:
+        RUN_METRICS['stages'] = {}
+        RUN_METRICS['counters'] = {}
+
+
+def record_stage_duration(name, seconds, **labels):
+    key = get_metric_key(name, labels)
+    with METRICS_LOCK:
+        RUN_METRICS['stages'][key] = RUN_METRICS['stages'].get(key, 0.0) + seconds
+
+
+def increment_counter(name, amount=1, **labels):
+    key = get_metric_key(name, labels)
+    with METRICS_LOCK:
+        RUN_METRICS['counters'][key] = RUN_METRICS['counters'].get(key, 0) + amount
+
+
+# Times the body of the with statement, adding it to the stage's total
+@contextlib.contextmanager
+def timed_stage(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage_duration(name, time.perf_counter() - start, **labels)
+
+
+# Adds metrics recorded elsewhere (e.g. in a worker process) into this run's metrics
+def merge_run_metrics(metrics):
+    with METRICS_LOCK:
+        for kind in ('stages', 'counters'):
+            for key, value in metrics[kind].items():
+                RUN_METRICS[kind][key] = RUN_METRICS[kind].get(key, 0) + value
+
+
+def format_metrics_json():
+    report = {}
+    for kind in ('stages', 'counters'):
+        report[kind] = [dict(labels, name=name, value=value)
+                        for (name, labels), value in sorted(RUN_METRICS[kind].items())]
+    return json.dumps(report, indent=2)
+
+
+def format_metrics_prometheus():
+    lines = []
+    for kind, suffix in (('stages', '_seconds'), ('counters', '')):
+        seen = set()
+        for (name, labels), value in sorted(RUN_METRICS[kind].items()):
+            if kind == 'stages':
+                metric, labels = 'nhc_cones_stage_seconds', (('stage', name),) + labels
+            else:
+                metric = f"nhc_cones_{name}{suffix}"
+            if metric not in seen:
+                lines.append(f"# TYPE {metric} gauge")
+                seen.add(metric)
+            label_text = ','.join(f'{label}="{label_value}"' for label, label_value in labels)
+            lines.append(f"{metric}{{{label_text}}} {value}" if label_text else f"{metric} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+# Writes the run's metrics as JSON or a Prometheus textfile, replacing the file in one step
+def write_metrics_report(file_name=None, metrics_format=None):
+    file_name = file_name or metricsReportFile
+    if not file_name:
+        return
+    metrics_format = metrics_format or metricsFormat
+    content = format_metrics_prometheus() if metrics_format == 'prometheus' else format_metrics_json()
+    with open(f"{file_name}.tmp", 'w') as out:
+        out.write(content)
+    os.replace(f"{file_name}.tmp", file_name)
+    print("Wrote run metrics to ", file_name)
+
+
+# Shared keep-alive session, so every download reuses the same pooled connections
+HTTP_SESSION = None
+
+
+def get_http_session():
+    import requests
+    global HTTP_SESSION
+    if HTTP_SESSION is None:
+        HTTP_SESSION = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max(fetchMaxWorkers, 1))
+        HTTP_SESSION.mount('https://', adapter)
+        HTTP_SESSION.mount('http://', adapter)
+    return HTTP_SESSION
+
+
+# The HTTP cache index maps each URL to its validators and the sha256 of its body
+# Bodies are stored once under <httpCacheDir>/objects/<sha256>, however many URLs or runs share them
+HTTP_CACHE_INDEX = None
+HTTP_CACHE_LOCK = threading.Lock()
+
+
+def get_http_cache_index():
+    global HTTP_CACHE_INDEX
+    with HTTP_CACHE_LOCK:
+        if HTTP_CACHE_INDEX is None:
+            HTTP_CACHE_INDEX = {}
+            index_file = path.join(httpCacheDir, 'index.json')
+            if os.path.exists(index_file):
+                try:
+                    with open(index_file, 'r') as index_in:
+                        HTTP_CACHE_INDEX = json.load(index_in)
+                except (OSError, ValueError) as e:
+                    print(f"WARNING: Ignoring unreadable HTTP cache index: {e}")
+        return HTTP_CACHE_INDEX
+
+
+def get_http_cache_object_path(digest):
+    return path.join(httpCacheDir, 'objects', digest)
+
+
+def store_http_cache_object(content):
+    digest = hashlib.sha256(content).hexdigest()
+    object_path = get_http_cache_object_path(digest)
+    if not os.path.exists(object_path):
+        os.makedirs(path.dirname(object_path), exist_ok=True)
+        temp_path = f"{object_path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as out:
+            out.write(content)
+        os.replace(temp_path, object_path)
+    return digest
+
+
+# Writes the cache index, and removes any stored bodies that no URL refers to anymore
+def save_http_cache():
+    if not useHttpCache or HTTP_CACHE_INDEX is None:
+        return
+    with HTTP_CACHE_LOCK:
+        os.makedirs(httpCacheDir, exist_ok=True)
+        index_file = path.join(httpCacheDir, 'index.json')
+        with open(f"{index_file}.tmp", 'w') as out:
+            json.dump(HTTP_CACHE_INDEX, out, indent=1, sort_keys=True)
+        os.replace(f"{index_file}.tmp", index_file)
+        referenced = set(entry['sha256'] for entry in HTTP_CACHE_INDEX.values())
+        objects_dir = path.join(httpCacheDir, 'objects')
+        if os.path.isdir(objects_dir):
+            for digest in os.listdir(objects_dir):
+                if digest not in referenced:
+                    os.remove(path.join(objects_dir, digest))
+
+
+# sha256 of every URL fetched during this pass of the pipeline, used to fingerprint the run's inputs
+RUN_FETCHED_DIGESTS = {}
+
+
+def record_fetched_digest(url, digest):
+    with HTTP_CACHE_LOCK:
+        RUN_FETCHED_DIGESTS[url] = digest
+
+
+# When this run's fetches have to be done by, as a time.monotonic() value, None for no limit
+FETCH_DEADLINE = None
+# Responses worth retrying, anything else is final
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+# Starts the run's fetch budget, budget seconds from now (fetchDeadline by default)
+def start_fetch_deadline(budget=None):
+    global FETCH_DEADLINE
+    budget = fetchDeadline if budget is None else budget
+    FETCH_DEADLINE = time.monotonic() + budget if budget else None
+
+
+# Seconds left in the run's fetch budget, None if there is no limit
+def get_fetch_time_left():
+    if FETCH_DEADLINE is None:
+        return None
+    return FETCH_DEADLINE - time.monotonic()
+
+
+# GETs url with the connect/read timeouts, cut down to what's left of the run's fetch budget
+# The body is read in chunks, so a slow download can't run past the deadline either
+# Connection errors, timeouts and RETRYABLE_STATUS_CODES are retried up to fetchRetries times, with exponential
+# backoff and jitter, as long as the deadline allows
+# Returns (response, content), raises TimeoutError once the deadline has passed, or the last error when out of retries
+def get_with_retries(url, headers=None):
+    import requests
+    session = get_http_session()
+    attempt = 0
+    while True:
+        time_left = get_fetch_time_left()
+        if time_left is not None and time_left <= 0:
+            raise TimeoutError(f"Fetch deadline passed before {url} was fetched")
+        connect_timeout = fetchConnectTimeout if time_left is None else min(fetchConnectTimeout, time_left)
+        read_timeout = fetchReadTimeout if time_left is None else min(fetchReadTimeout, time_left)
+        try:
+            with session.get(url, headers=headers, timeout=(connect_timeout, read_timeout), stream=True) as response:
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    chunks = []
+                    for chunk in response.iter_content(64 * 1024):
+                        chunks.append(chunk)
+                        time_left = get_fetch_time_left()
+                        if time_left is not None and time_left <= 0:
+                            raise TimeoutError(f"Fetch deadline passed while downloading {url}")
+                    return response, b''.join(chunks)
+                error = requests.HTTPError(f"{response.status_code} Error for url: {url}", response=response)
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            error = e
+        attempt += 1
+        delay = fetchRetryDelay * (2 ** (attempt - 1)) * random.uniform(0.5, 1)
+        time_left = get_fetch_time_left()
+        if attempt > fetchRetries or (time_left is not None and delay >= time_left):
+            raise error
+        print(f"WARNING: Fetching {url} failed ({error}), retry {attempt} in {delay:.1f} seconds")
+        increment_counter('http_retries')
+        time.sleep(delay)
+
+
+# Gets the body of url, going through the HTTP cache when useHttpCache is set
+# If the fetch fails, the last good copy from the HTTP cache is used instead, when there is one
+# Returns (content, from_cache), where from_cache means the server answered 304 Not Modified, or the cached copy
+# stood in for a failed fetch
+def fetch_url_content(url):
+    import requests
+    increment_counter('http_requests')
+    if not useHttpCache:
+        response, content = get_with_retries(url)
+        response.raise_for_status()
+        increment_counter('bytes_downloaded', len(content))
+        record_fetched_digest(url, hashlib.sha256(content).hexdigest())
+        return content, False
+
+    index = get_http_cache_index()
+    entry = index.get(url)
+    headers = {}
+    if entry is not None and os.path.exists(get_http_cache_object_path(entry['sha256'])):
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+    try:
+        response, content = get_with_retries(url, headers)
+        if not (response.status_code == 304 and headers):
+            response.raise_for_status()
+    except (requests.RequestException, TimeoutError) as e:
+        if entry is None or not os.path.exists(get_http_cache_object_path(entry['sha256'])):
+            raise
+        print(f"WARNING: Fetching {url} failed ({e}), using the last good copy")
+        increment_counter('fetch_fallbacks')
+        record_fetched_digest(url, entry['sha256'])
+        with open(get_http_cache_object_path(entry['sha256']), 'rb') as cached:
+            return cached.read(), True
+    if response.status_code == 304 and headers:
+        increment_counter('http_cache_hits')
+        record_fetched_digest(url, entry['sha256'])
+        with open(get_http_cache_object_path(entry['sha256']), 'rb') as cached:
+            return cached.read(), True
+    increment_counter('bytes_downloaded', len(content))
+    digest = store_http_cache_object(content)
+    record_fetched_digest(url, digest)
+    with HTTP_CACHE_LOCK:
+        index[url] = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'sha256': digest,
+        }
+    return content, False
+
+
+def download_file(url, file_name):
+    if os.path.exists(file_name):
+        print("file ", file_name, " already downloaded")
+        increment_counter('files_already_present')
+        with open(file_name, 'rb') as existing:
+            record_fetched_digest(url, hashlib.sha256(existing.read()).hexdigest())
+        return file_name
+    print("file: ", url)
+    content, from_cache = fetch_url_content(url)
+    if from_cache:
+        print("file ", file_name, " not modified, using cached copy")
+    with open(file_name, 'wb') as out:
+        out.write(content)
+    return file_name
+
+
+# Downloads every URL in urls into the cwd (named after the last path component), using a thread pool
+# Returns the list of local file names, in the same order as urls (duplicates removed)
+def fetch_files(urls, max_workers=None):
+    jobs = {}
+    for url in urls:
+        file_name = path.basename(urlparse(url).path)
+        jobs.setdefault(file_name, url)
+    if not jobs:
+        return []
+    workers = max(1, min(max_workers or fetchMaxWorkers, len(jobs)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(download_file, url, file_name) for file_name, url in jobs.items()]
+        try:
+            for future in as_completed(futures):
+                # Re-raise any download failure
+                future.result()
+        finally:
+            save_http_cache()
+    return list(jobs)
+
+
+GIS_PAGE_URL = 'https://www.nhc.noaa.gov/gis/'
+# Every storm's latest CONE/TRACK link on the GIS page, wherever it sits in the page's layout
+GIS_PRODUCT_LINK_PATTERN = re.compile(rb'''href\s*=\s*["']\s*([^"']*?/(\w+?)_(CONE|TRACK)_latest\.kmz)\s*["']''',
+                                      re.IGNORECASE)
+# The manifest from the last get_product_manifest call in this process
+PRODUCT_MANIFEST = None
+
+
+def get_manifest_file():
+    return path.join(httpCacheDir, 'gis_manifest.json')
+
+
+# Pulls every CONE/TRACK link out of the GIS page in one pass over its bytes
+# Returns {storm id: {'CONE': url, 'TRACK': url}}
+def parse_gis_page(page_content, page_url=GIS_PAGE_URL):
+    storms = {}
+    for match in GIS_PRODUCT_LINK_PATTERN.finditer(page_content):
+        href, storm, product = (group.decode('UTF-8') for group in match.groups())
+        storms.setdefault(storm.upper(), {})[product.upper()] = urljoin(page_url, href.strip())
+    return storms
+
+
+# Fetches the GIS page once and returns the storm products it lists, as a manifest:
+# {'page_sha256': ..., 'storms': {storm id: {product: url}}}
+# The manifest is kept in httpCacheDir, so an unchanged page isn't parsed again, even by a new process
+# The page only links each storm's *_latest.kmz aliases, so it says nothing about whether a product changed,
+# the products themselves are always revalidated
+def get_product_manifest():
+    global PRODUCT_MANIFEST
+    page_content, _ = fetch_url_content(GIS_PAGE_URL)
+    page_digest = hashlib.sha256(page_content).hexdigest()
+    previous = PRODUCT_MANIFEST
+    if previous is None and os.path.exists(get_manifest_file()):
+        try:
+            with open(get_manifest_file(), 'r') as manifest_in:
+                previous = json.load(manifest_in)
+        except (OSError, ValueError):
+            previous = None
+    if previous is not None and previous['page_sha256'] == page_digest:
+        increment_counter('manifest_reuses')
+        PRODUCT_MANIFEST = previous
+        return PRODUCT_MANIFEST
+    with timed_stage('manifest'):
+        PRODUCT_MANIFEST = {'page_sha256': page_digest, 'storms': parse_gis_page(page_content)}
+    if useHttpCache:
+        os.makedirs(httpCacheDir, exist_ok=True)
+        with open(f"{get_manifest_file()}.tmp", 'w') as out:
+            json.dump({'page_sha256': page_digest, 'storms': PRODUCT_MANIFEST['storms']}, out, indent=1)
+        os.replace(f"{get_manifest_file()}.tmp", get_manifest_file())
+    return PRODUCT_MANIFEST
+
+
+# The manifest's products for storms whose ids start with one of storm_prefixes, as (storm id, product, url)
+def get_manifest_products(manifest, storm_prefixes):
+    return [(storm, product, url) for storm, products in sorted(manifest['storms'].items())
+            if storm.startswith(tuple(storm_prefixes)) for product, url in sorted(products.items())]
 
 
 def bound_x_to_image(image_width, x_coord):
@@ -246,367 +760,1033 @@ def get_image_longitude_x_pixel_with_list(longitude_list, decimal_longitude):
             return pair[0]
 
 
+# Batched equivalent of bound_x_to_image
+# Takes arrays of x pixels and their valid mask, returns the bounded (x pixels, valid mask)
+def bound_x_pixels_to_image(image_width, x_coords, valid):
+    import numpy as np
+    x_coords = np.array(x_coords)
+    valid = np.array(valid)
+    out_of_bounds = valid & ((x_coords < 0) | (x_coords > (image_width - 1)))
+    if drawOnExtents:
+        x_coords[valid] = np.clip(x_coords[valid], 0, image_width - 1)
+    else:
+        valid &= ~out_of_bounds
+    return x_coords, valid
+
+
+# Batched equivalent of get_pixel_coord, for the points that fall between two control points
+# lower_bounds/upper_bounds/deltas are arrays, coord_list is used for bounding to the map
+def get_pixel_coords(coord_list, deltas, lower_bounds, upper_bounds):
+    import numpy as np
+    pixel_deltas = (lower_bounds - upper_bounds)
+    ret_vals = np.trunc(upper_bounds + (pixel_deltas * deltas)).astype(np.int64)
+    valid = np.ones(ret_vals.shape, dtype=bool)
+    # Bound to map
+    out_of_bounds = (ret_vals < coord_list[-1][0]) | (ret_vals > coord_list[0][0])
+    if drawOnExtents:
+        ret_vals = np.clip(ret_vals, coord_list[-1][0], coord_list[0][0])
+    else:
+        valid &= ~out_of_bounds
+    return ret_vals, valid
+
+
+# Batched equivalent of get_image_latitude_y_pixel_with_list
+# Takes an array of latitudes, returns (y pixels, valid mask) arrays
+# Entries where valid is False are the ones get_image_latitude_y_pixel_with_list returns None for
+def get_image_latitude_y_pixels_with_list(latitude_list, decimal_latitudes):
+    import numpy as np
+    latitudes = np.asarray(decimal_latitudes, dtype=float)
+    pixels = np.array([pair[0] for pair in latitude_list], dtype=np.int64)
+    degrees = np.array([pair[1] for pair in latitude_list], dtype=float)
+    y_coords = np.zeros(latitudes.shape, dtype=np.int64)
+    valid = np.ones(latitudes.shape, dtype=bool)
+
+    below = latitudes <= degrees[0]
+    above = latitudes >= degrees[-1]
+    y_coords[below] = pixels[0]
+    y_coords[above] = pixels[-1]
+    if not drawOnExtents:
+        valid &= ~(below | above)
+
+    inside = ~(below | above)
+    # Index of the first control point at or above each latitude
+    upper = np.searchsorted(degrees, latitudes[inside], side='left')
+    exact = degrees[upper] == latitudes[inside]
+    lower = np.maximum(upper - 1, 0)
+    deltas = (degrees[upper] - latitudes[inside]) / 5.0
+    inside_y, inside_valid = get_pixel_coords(latitude_list, deltas, pixels[lower], pixels[upper])
+    y_coords[inside] = np.where(exact, pixels[upper], inside_y)
+    valid[inside] = exact | inside_valid
+    return y_coords, valid
+
+
+# Batched equivalent of get_image_longitude_x_pixel_with_list
+# Takes an array of longitudes, returns (x pixels, valid mask) arrays
+def get_image_longitude_x_pixels_with_list(longitude_list, decimal_longitudes):
+    import numpy as np
+    longitudes = np.asarray(decimal_longitudes, dtype=float)
+    pixels = np.array([pair[0] for pair in longitude_list], dtype=np.int64)
+    degrees = np.array([pair[1] for pair in longitude_list], dtype=float)
+    x_coords = np.zeros(longitudes.shape, dtype=np.int64)
+    valid = np.ones(longitudes.shape, dtype=bool)
+
+    east = longitudes >= degrees[0]
+    west = longitudes <= degrees[-1]
+    x_coords[east] = pixels[0]
+    x_coords[west] = pixels[-1]
+    if not drawOnExtents:
+        valid &= ~(east | west)
+
+    inside = ~(east | west)
+    # The longitude list runs east to west, so search the negated (ascending) degrees
+    # for the first control point at or west of each longitude
+    upper = np.searchsorted(-degrees, -longitudes[inside], side='left')
+    exact = degrees[upper] == longitudes[inside]
+    lower = np.maximum(upper - 1, 0)
+    deltas = (longitudes[inside] - degrees[upper]) / 5.0
+    inside_x, inside_valid = get_pixel_coords(longitude_list, deltas, pixels[lower], pixels[upper])
+    x_coords[inside] = np.where(exact, pixels[upper], inside_x)
+    valid[inside] = exact | inside_valid
+    return x_coords, valid
+
+
+# For maps that use one longitude list for negative longitudes and another for positive ones
+def get_image_longitude_x_pixels_with_split_lists(negative_list, positive_list, decimal_longitudes):
+    import numpy as np
+    longitudes = np.asarray(decimal_longitudes, dtype=float)
+    x_coords = np.zeros(longitudes.shape, dtype=np.int64)
+    valid = np.zeros(longitudes.shape, dtype=bool)
+    negative = longitudes < 0
+    x_coords[negative], valid[negative] = get_image_longitude_x_pixels_with_list(negative_list, longitudes[negative])
+    x_coords[~negative], valid[~negative] = get_image_longitude_x_pixels_with_list(positive_list, longitudes[~negative])
+    return x_coords, valid
+
+
+def get_draw_font():
+    global DRAW_FONT
+    if DRAW_FONT is None:
+        from PIL import ImageFont
+        try:
+            DRAW_FONT = ImageFont.truetype('Pillow/Tests/fonts/FreeMono.ttf', 15)
+        except:
+            print("Failed to load FreeMono.ttf, trying load_default()")
+            DRAW_FONT = ImageFont.load_default()
+    return DRAW_FONT
+
+
 def remove_logos_and_add_unofficial_text(image_draw, text_position_data):
     # Remove Logos
     image_draw.rectangle((0, 0, 63, 61), DRAW_WHITE)
     image_draw.rectangle((838, 0, 898, 61), DRAW_WHITE)
     if addDisclaimerText:
         for loc in text_position_data:
-            image_draw.text((loc[0], loc[1]), UNOFFICIAL_STRING, loc[2], font=DRAW_FONT)
+            image_draw.text((loc[0], loc[1]), UNOFFICIAL_STRING, loc[2], font=get_draw_font())
+
+
+# One storm's parsed products, as plain numbers, so renderers never go back to the KML strings
+# coords is a contiguous (points, 2) float array of (lon, lat) for every cone ring back to back, ring_offsets holds
+# where each ring starts and ends in it (len(rings) + 1 entries), and bounds is the cone's
+# (min lon, max lon, min lat, max lat) box, or None without a cone
+# init_lat, init_lon and max_wind come from the TRACK product, init_lat is None without one
+# Slots and a tuple state keep it small, so it pickles cheaply into the render worker processes
+class StormModel:
+    __slots__ = ('storm_id', 'coords', 'ring_offsets', 'bounds', 'init_lat', 'init_lon', 'max_wind')
+
+    def __init__(self, storm_id, coords=None, ring_offsets=None, bounds=None, init_lat=None, init_lon=None,
+                 max_wind=None):
+        self.storm_id = storm_id
+        self.coords = coords
+        self.ring_offsets = ring_offsets
+        self.bounds = bounds
+        self.init_lat = init_lat
+        self.init_lon = init_lon
+        self.max_wind = max_wind
+
+    def __getstate__(self):
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    def __setstate__(self, state):
+        for slot, value in zip(self.__slots__, state):
+            setattr(self, slot, value)
+
+    def has_cone(self):
+        return self.coords is not None and len(self.ring_offsets) > 1
+
+    def get_point_count(self):
+        return 0 if self.coords is None else len(self.coords)
+
+    # Each ring as a (points, 2) view into coords
+    def get_rings(self):
+        if not self.has_cone():
+            return []
+        offsets = self.ring_offsets.tolist()
+        return [self.coords[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+    # What get_render_digest hashes for this storm
+    def get_digest_state(self):
+        coords_digest = None
+        if self.coords is not None:
+            coords_digest = hashlib.sha256(self.coords.tobytes() + self.ring_offsets.tobytes()).hexdigest()
+        return [self.storm_id, coords_digest, self.init_lat, self.init_lon, self.max_wind]
+
+
+# Turns rings of "lon,lat,alt" coordinate strings into (coords, ring_offsets) arrays for StormModel
+def get_ring_arrays(rings):
+    import numpy as np
+    coords = np.array([coord.split(',')[:2] for ring in rings for coord in ring], dtype=float).reshape(-1, 2)
+    ring_offsets = np.cumsum([0] + [len(ring) for ring in rings], dtype=np.int64)
+    return np.ascontiguousarray(coords), ring_offsets
+
+
+# Turns a maxWindMPH value into a number, e.g. "45" into 45, None if it isn't one
+def parse_max_wind(text):
+    try:
+        max_wind = float(text)
+    except (TypeError, ValueError):
+        return None
+    return int(max_wind) if max_wind.is_integer() else max_wind
+
+
+# Parsed products from the previous build_storm_cache call in this process, keyed by (product, sha256 of the kmz)
+# Lets a long-running process (see run_daemon) skip re-parsing storms whose advisories have not changed
+PARSED_PRODUCT_CACHE = {}
 
 
-def modify_image(image, lat_func, long_func):
+# CONE products parse to (coords, ring_offsets, bounds), TRACK products to (lat, lon, max wind), all numbers
+def parse_storm_product(file, product):
+    if product == 'CONE':
+        if useStreamingKmlParser:
+            rings = stream_cone_rings_from_kmz(file)
+        else:
+            rings = extract_cone_rings_from_kmz(file)
+        coords, ring_offsets = get_ring_arrays(rings)
+        return coords, ring_offsets, get_cone_bounds(coords)
+    if useStreamingKmlParser:
+        lat_val, lon_val, max_wind = stream_speed_from_kmz(file)
+    else:
+        lat_val, lon_val, max_wind = extract_speed_from_kmz(file)
+    if lat_val is None:
+        return None, None, None
+    return float(lat_val), float(lon_val), parse_max_wind(max_wind)
+
+
+# Parses every downloaded CONE and TRACK product exactly once for this run
+# Returns a dict of StormModel keyed by storm id, e.g. 'AL052025', which every basin renderer reads from
+def build_storm_cache(kmz_files=None):
+    if kmz_files is None:
+        kmz_files = glob.glob("*.kmz")
+    products = []
+    for file in sorted(kmz_files):
+        m = re.match(r'(\w+?)_(CONE|TRACK)', path.basename(file))
+        if not m:
+            continue
+        storm, product = m.groups()
+        products.append((storm, product, file))
+    return build_storm_cache_from_products(products)
+
+
+# Same as build_storm_cache, for products whose storm isn't in the file name the usual way
+# products is a list of (storm id, 'CONE' or 'TRACK', kmz file name)
+def build_storm_cache_from_products(products):
+    global PARSED_PRODUCT_CACHE
+    storm_cache = {}
+    parsed_products = {}
+    for storm, product, file in products:
+        with open(file, 'rb') as kmz:
+            product_key = (product, hashlib.sha256(kmz.read()).hexdigest())
+        parsed = PARSED_PRODUCT_CACHE.get(product_key)
+        if parsed is None:
+            parsed = parse_storm_product(file, product)
+        else:
+            increment_counter('parse_cache_hits')
+        parsed_products[product_key] = parsed
+        storm_model = storm_cache.setdefault(storm, StormModel(storm))
+        if product == 'CONE':
+            storm_model.coords, storm_model.ring_offsets, storm_model.bounds = parsed
+        else:
+            storm_model.init_lat, storm_model.init_lon, storm_model.max_wind = parsed
+    # Only keep what this pass used, so the cache can't grow without bound
+    PARSED_PRODUCT_CACHE = parsed_products
+    return storm_cache
+
+
+# Decoded base images, keyed by file name, as (sha256 of the file, RGB image)
+BASE_IMAGE_CACHE = {}
+
+
+# Opens a base image as RGB, reusing the decoded image from an earlier pass if the file has not changed
+# Returns a copy, so callers can draw on it freely
+def open_base_image(file_name):
+    from PIL import Image
+    with open(file_name, 'rb') as base_file:
+        content = base_file.read()
+    digest = hashlib.sha256(content).hexdigest()
+    cached = BASE_IMAGE_CACHE.get(file_name)
+    if cached is None or cached[0] != digest:
+        with Image.open(io.BytesIO(content)) as base_image:
+            cached = (digest, base_image.convert('RGB'))
+        BASE_IMAGE_CACHE[file_name] = cached
+    return cached[1].copy()
+
+
+# Prepared base layers (logos blanked, disclaimer text drawn), keyed by basin name, as (layer key, RGB image)
+PREPARED_BASE_CACHE = {}
+
+
+def get_base_layer_dir():
+    return path.join(httpCacheDir, 'base_layers')
+
+
+# Identifies everything that goes into a basin's prepared base layer: the base image bytes, where the disclaimer
+# text goes, and the font it's drawn with
+def get_base_layer_key(basin, base_digest):
+    font_path = getattr(get_draw_font(), 'path', None)
+    layer = [base_digest, addDisclaimerText, UNOFFICIAL_STRING, basin['text_locations'],
+             font_path if isinstance(font_path, str) else 'default']
+    return hashlib.sha256(json.dumps(layer).encode('UTF-8')).hexdigest()
+
+
+# Opens a basin's base image with the logos already blanked and the disclaimer text already drawn
+# The prepared layer is kept in memory, and with useBaseLayerDiskCache also as a raw RGB buffer, so a new process
+# (the next scheduled run, or an archive worker) can load it without decoding the PNG or drawing anything
+# Returns a copy, so callers can draw on it freely
+def open_prepared_base_image(basin):
+    from PIL import Image, ImageDraw
+    name = basin['name']
+    with open(basin['base_image_file'], 'rb') as base_file:
+        base_digest = hashlib.sha256(base_file.read()).hexdigest()
+    layer_key = get_base_layer_key(basin, base_digest)
+    cached = PREPARED_BASE_CACHE.get(name)
+    if cached is not None and cached[0] == layer_key:
+        increment_counter('base_layer_cache_hits', basin=name)
+        return cached[1].copy()
+    layer_file = None
+    layer_image = None
+    if useBaseLayerDiskCache:
+        with Image.open(basin['base_image_file']) as base_header:
+            width, height = base_header.size
+        layer_file = path.join(get_base_layer_dir(), f"{name}_{layer_key}_{width}x{height}.raw")
+        if os.path.exists(layer_file):
+            with open(layer_file, 'rb') as layer_in:
+                layer_image = Image.frombytes('RGB', (width, height), layer_in.read())
+            increment_counter('base_layer_disk_hits', basin=name)
+    if layer_image is None:
+        layer_image = open_base_image(basin['base_image_file'])
+        remove_logos_and_add_unofficial_text(ImageDraw.Draw(layer_image), basin['text_locations'])
+        if layer_file is not None:
+            os.makedirs(get_base_layer_dir(), exist_ok=True)
+            # Only the newest layer of each basin is kept
+            for old_layer in glob.glob(path.join(get_base_layer_dir(), f"{name}_*.raw")):
+                if old_layer != layer_file:
+                    with contextlib.suppress(OSError):
+                        os.remove(old_layer)
+            with open(f"{layer_file}.{os.getpid()}.tmp", 'wb') as out:
+                out.write(layer_image.tobytes())
+            os.replace(f"{layer_file}.{os.getpid()}.tmp", layer_file)
+    PREPARED_BASE_CACHE[name] = (layer_key, layer_image)
+    return layer_image.copy()
+
+
+# Bounding box of every ring in a cone, from its (points, 2) coords array, as (min lon, max lon, min lat, max lat)
+def get_cone_bounds(lon_lat):
+    if lon_lat.size == 0:
+        return None
+    return (float(lon_lat[:, 0].min()), float(lon_lat[:, 0].max()),
+            float(lon_lat[:, 1].min()), float(lon_lat[:, 1].max()))
+
+
+# A map's viewport, derived from its control point lists, as a list of (min lon, max lon, min lat, max lat) boxes
+# Maps with split negative/positive longitude lists get one box per list
+def get_viewport_with_lists(latitude_list, *longitude_lists):
+    min_lat = latitude_list[0][1]
+    max_lat = latitude_list[-1][1]
+    return [(longitude_list[-1][1], longitude_list[0][1], min_lat, max_lat) for longitude_list in longitude_lists]
+
+
+# Whether a cone's bounding box can land on the map at all
+# With drawOnExtents everything gets clamped onto the map, so nothing can be rejected
+def cone_intersects_viewport(bounds, viewport):
+    if viewport is None or bounds is None or drawOnExtents:
+        return True
+    min_lon, max_lon, min_lat, max_lat = bounds
+    for view_min_lon, view_max_lon, view_min_lat, view_max_lat in viewport:
+        if min_lon <= view_max_lon and max_lon >= view_min_lon and min_lat <= view_max_lat and max_lat >= view_min_lat:
+            return True
+    return False
+
+
+# Projects each ring of a cone in one call, rings being (points, 2) arrays of (lon, lat)
+# Returns a list of (x pixels, y pixels, valid mask) arrays, one entry per ring, and how many points were skipped
+def project_cone_rings(image_width, rings, lat_batch_func, long_batch_func):
+    import numpy as np
+    projected_rings = []
     skip_count = 0
-    for file in glob.glob("*CONE*.kml"):
-        coords = extract_coords_from_kml(file)
-        for coord in coords:
-            split = coord.split(',')
-            x_coord = bound_x_to_image(image.size[0], long_func(float(split[0])))
-            y_coord = lat_func(float(split[1]))
-            if not drawOnExtents and (x_coord is None or y_coord is None):
-                skip_count += 1
-                continue
-            # print("latitude ", split[1], " gave y_coord: ", y_coord)
-            image.putpixel((x_coord, y_coord), (0, 0, 0, 255))
+    for lon_lat in rings:
+        x_coords, x_valid = long_batch_func(lon_lat[:, 0])
+        x_coords, x_valid = bound_x_pixels_to_image(image_width, x_coords, x_valid)
+        y_coords, y_valid = lat_batch_func(lon_lat[:, 1])
+        valid = x_valid & y_valid
+        skip_count += int(np.count_nonzero(~valid))
+        projected_rings.append((x_coords, y_coords, valid))
+    return projected_rings, skip_count
+
+
+# Splits a projected ring into runs of consecutive drawable points, so skipped points break the outline
+def split_valid_runs(x_coords, y_coords, valid):
+    import numpy as np
+    points = np.stack([x_coords, y_coords], axis=1)
+    breaks = np.flatnonzero(np.diff(valid.astype(np.int8))) + 1
+    runs = []
+    for run_points, run_valid in zip(np.split(points, breaks), np.split(valid, breaks)):
+        if run_valid.size and run_valid[0]:
+            runs.append([tuple(point) for point in run_points.tolist()])
+    return runs
+
+
+# Draws projected cone rings with one ImageDraw call per ring (or run of points), instead of one putpixel per vertex
+# coneOutlineStyle picks between the original dotted outline, a connected line, or a filled cone
+def draw_cone_rings(image, projected_rings):
+    from PIL import Image, ImageDraw
+    image_draw = ImageDraw.Draw(image)
+    if coneOutlineStyle == 'filled':
+        # The fill uses every projected point, valid or not: points past the control points sit on the map's edge,
+        # the rest keep their interpolated pixel, and polygon clips whatever lands off the image
+        # The valid mask only decides which points get an outline
+        fill_mask = None
+        for x_coords, y_coords, valid in projected_rings:
+            if valid.size > 2 and valid.any():
+                if fill_mask is None:
+                    fill_mask = Image.new('L', image.size, 0)
+                ImageDraw.Draw(fill_mask).polygon(list(zip(x_coords.tolist(), y_coords.tolist())), fill=coneFillOpacity)
+        if fill_mask is not None:
+            image.paste(coneFillColor, (0, 0) + image.size, fill_mask)
+    for x_coords, y_coords, valid in projected_rings:
+        if coneOutlineStyle == 'dotted':
+            image_draw.point(list(zip(x_coords[valid].tolist(), y_coords[valid].tolist())), fill=DRAW_BLACK)
+            continue
+        for run in split_valid_runs(x_coords, y_coords, valid):
+            if len(run) > 1:
+                image_draw.line(run, fill=DRAW_BLACK, width=coneOutlineWidth)
+            else:
+                image_draw.point(run, fill=DRAW_BLACK)
+
+
+# lat_batch_func/long_batch_func are the array versions of lat_func/long_func, used when useBatchProjection is set
+# viewport is the map's get_viewport_with_lists boxes, storms entirely outside of it are skipped before any projection
+# basin only labels the run metrics
+def modify_image(image, lat_func, long_func, storm_cache=None, lat_batch_func=None, long_batch_func=None,
+                 viewport=None, basin=None):
+    from PIL import ImageDraw
+    if storm_cache is None:
+        storm_cache = build_storm_cache()
+    metric_labels = {'basin': basin} if basin else {}
+    use_batch = useBatchProjection and lat_batch_func is not None and long_batch_func is not None
+    skip_count = 0
+    skipped_storms = 0
+    point_count = 0
+    projected_rings = []
+    project_start = time.perf_counter()
+    for storm, storm_model in sorted(storm_cache.items()):
+        if not storm_model.has_cone():
+            continue
+        rings = storm_model.get_rings()
+        if not cone_intersects_viewport(storm_model.bounds, viewport):
+            skipped_storms += 1
+            continue
+        point_count += storm_model.get_point_count()
+        if use_batch:
+            storm_rings, storm_skip_count = project_cone_rings(image.size[0], rings, lat_batch_func, long_batch_func)
+            projected_rings.extend(storm_rings)
+            skip_count += storm_skip_count
+            if skip_count > 0:
+                print("Skipped ", skip_count, " in ", storm)
+            continue
+        for ring in rings:
+            for lon_val, lat_val in ring.tolist():
+                x_coord = bound_x_to_image(image.size[0], long_func(lon_val))
+                y_coord = lat_func(lat_val)
+                if not drawOnExtents and (x_coord is None or y_coord is None):
+                    skip_count += 1
+                    continue
+                # print("latitude ", split[1], " gave y_coord: ", y_coord)
+                image.putpixel((x_coord, y_coord), (0, 0, 0, 255))
         if skip_count > 0:
-            print("Skipped ", skip_count, " in ", file)
+            print("Skipped ", skip_count, " in ", storm)
+    # The non-batch path draws as it projects, so its drawing time is included here
+    record_stage_duration('project', time.perf_counter() - project_start, **metric_labels)
+    increment_counter('points_projected', point_count - skip_count, **metric_labels)
+    increment_counter('points_skipped', skip_count, **metric_labels)
+    increment_counter('storms_skipped', skipped_storms, **metric_labels)
+    if skipped_storms > 0:
+        print("Skipped ", skipped_storms, " storms outside of the map")
+    if projected_rings:
+        with timed_stage('draw', **metric_labels):
+            draw_cone_rings(image, projected_rings)
 
     # Now try to draw the windspeed on the image
     image_draw = None
-    for file in glob.glob("*TRACK*.kml"):
-        lat_val, lon_val, max_wind = extract_speed_from_kml(file)
+    for storm, storm_model in sorted(storm_cache.items()):
+        lat_val, lon_val, max_wind = storm_model.init_lat, storm_model.init_lon, storm_model.max_wind
         if lat_val is not None:
             if image_draw is None:
                 image_draw = ImageDraw.Draw(image)
-            x_coord = bound_x_to_image(image.size[0], long_func(float(lon_val)))
+            x_coord = bound_x_to_image(image.size[0], long_func(lon_val))
 
-            y_coord = lat_func(float(lat_val))
+            y_coord = lat_func(lat_val)
             # print(f"{lon_val}, {lat_val} - {max_wind}")
-            if x_coord is not None and y_coord is not None:
+            if x_coord is not None and y_coord is not None and max_wind is not None:
                 # Adjust eastward a tiny bit
                 x_coord += 11
                 # Adjust northward a tiny bit
                 y_coord -= 5
-                image_draw.text((x_coord, y_coord), f"{max_wind}mph", DRAW_BLACK, font=DRAW_FONT)
-
-
-# Maps the X coordinate on the image to an associated longitude
-atl_longitude_points = []
-atl_longitude_points.append((899, -10))  # Eastern limit
-atl_longitude_points.append((852, -15))
-atl_longitude_points.append((805, -20))
-atl_longitude_points.append((757, -25))
-atl_longitude_points.append((710, -30))
-atl_longitude_points.append((662, -35))
-atl_longitude_points.append((615, -40))
-atl_longitude_points.append((568, -45))
-atl_longitude_points.append((520, -50))
-atl_longitude_points.append((473, -55))
-atl_longitude_points.append((426, -60))
-atl_longitude_points.append((378, -65))
-atl_longitude_points.append((331, -70))
-atl_longitude_points.append((284, -75))
-atl_longitude_points.append((236, -80))
-atl_longitude_points.append((189, -85))
-atl_longitude_points.append((141, -90))
-atl_longitude_points.append((94, -95))
-atl_longitude_points.append((47, -100))
-atl_longitude_points.append((0, -105))  # Western limit
-
-# Maps the Y coordinate on the image to an associated latitude
-atl_latitude_points = []
-atl_latitude_points.append((595, 0))  # lower limit
-atl_latitude_points.append((558, 5))
-atl_latitude_points.append((511, 10))
-atl_latitude_points.append((462, 15))
-atl_latitude_points.append((413, 20))
-atl_latitude_points.append((362, 25))
-atl_latitude_points.append((309, 30))
-atl_latitude_points.append((254, 35))
-atl_latitude_points.append((194, 40))
-atl_latitude_points.append((131, 45))
-atl_latitude_points.append((64, 50))  # upper limit
-
-
-def get_atl_image_latitude_y_pixel(decimal_latitude):
-    return get_image_latitude_y_pixel_with_list(atl_latitude_points, decimal_latitude)
-
-
-def get_atl_image_longitude_x_pixel(decimal_longitude):
-    return get_image_longitude_x_pixel_with_list(atl_longitude_points, decimal_longitude)
-
-
-atl_text_locations = []
-atl_text_locations.append((20, 40, DRAW_BLACK))
-atl_text_locations.append((700, 40, DRAW_BLACK))
-atl_text_locations.append((15, 525, DRAW_WHITE))
-atl_text_locations.append((700, 100, DRAW_WHITE))
-atl_text_locations.append((700, 540, DRAW_WHITE))
-
-
-def do_mod_atl_image():
-    eastern = pytz.timezone('US/Eastern')
-    now_time_loc = datetime.datetime.now(eastern)
-    time_string = now_time_loc.strftime("!! %I:%M %p %Z !!")
-    date_string = now_time_loc.strftime("!! %a %b %d %Y !!")
-    with Image.open('two_atl_7d0.png').convert('RGB') as image:
-        draw = ImageDraw.Draw(image)
-        remove_logos_and_add_unofficial_text(draw, atl_text_locations)
-
-        # Add time and date the image was generated
-        draw.text((700, 115), time_string, (255, 255, 255), font=DRAW_FONT)
-        draw.text((700, 130), date_string, (255, 255, 255), font=DRAW_FONT)
-        modify_image(image, get_atl_image_latitude_y_pixel, get_atl_image_longitude_x_pixel)
-        # testing coordinate generation
-        # for longitude in range(0, 45):
-        #     longitude = -105 + (longitude * 2.5)
-        #     x_coord = bound_x_to_image(image.size[0], get_atl_image_longitude_x_pixel(longitude))
-        #     print("longitude: ", longitude, " x_coord: ", x_coord)
-        #     for latitude in range(0, 25):
-        #         latitude = latitude * 2.5
-        #         y_coord = get_atl_image_latitude_y_pixel(latitude)
-        #         # print("latitude ", latitude, " gave y_coord: ", y_coord)
-        #         image.putpixel((x_coord, y_coord), (0, 0, 0, 255))
-        image.save('atl_latest.png')
-
-
-# Maps the X coordinate on the image to an associated longitude
-east_pac_longitude_points = []
-east_pac_longitude_points.append((899, -75))  # Eastern limit
-east_pac_longitude_points.append((835, -80))
-east_pac_longitude_points.append((771, -85))
-east_pac_longitude_points.append((706, -90))
-east_pac_longitude_points.append((642, -95))
-east_pac_longitude_points.append((578, -100))
-east_pac_longitude_points.append((514, -105))
-east_pac_longitude_points.append((449, -110))
-east_pac_longitude_points.append((385, -115))
-east_pac_longitude_points.append((321, -120))
-east_pac_longitude_points.append((256, -125))
-east_pac_longitude_points.append((192, -130))
-east_pac_longitude_points.append((128, -135))
-east_pac_longitude_points.append((64, -140))
-east_pac_longitude_points.append((0, -145))  # Western limit
-
-# These coordinates changed in 2025
-east_pac_longitude_points_2025 = []
-east_pac_longitude_points_2025.append((899, -76))  # Eastern limit
-east_pac_longitude_points_2025.append((875, -80))
-east_pac_longitude_points_2025.append((833, -85))
-east_pac_longitude_points_2025.append((792, -90))
-east_pac_longitude_points_2025.append((750, -95))
-east_pac_longitude_points_2025.append((708, -100))
-east_pac_longitude_points_2025.append((667, -105))
-east_pac_longitude_points_2025.append((625, -110))
-east_pac_longitude_points_2025.append((583, -115))
-east_pac_longitude_points_2025.append((542, -120))
-east_pac_longitude_points_2025.append((500, -125))
-east_pac_longitude_points_2025.append((458, -130))
-east_pac_longitude_points_2025.append((417, -135))
-east_pac_longitude_points_2025.append((375, -140))
-east_pac_longitude_points_2025.append((333, -145))
-east_pac_longitude_points_2025.append((292, -150))
-east_pac_longitude_points_2025.append((250, -155))
-east_pac_longitude_points_2025.append((208, -160))
-east_pac_longitude_points_2025.append((167, -165))
-east_pac_longitude_points_2025.append((125, -170))
-east_pac_longitude_points_2025.append((83, -175))
-east_pac_longitude_points_2025.append((42, -180))
-east_pac_longitude_points_2025.append((0, -185)) # Western limit
-
-east_pac_longitude_points_2025_positive = []
-east_pac_longitude_points_2025_positive.append((458, 230))
-east_pac_longitude_points_2025_positive.append((417, 225))
-east_pac_longitude_points_2025_positive.append((375, 220))
-east_pac_longitude_points_2025_positive.append((333, 215))
-east_pac_longitude_points_2025_positive.append((292, 210))
-east_pac_longitude_points_2025_positive.append((250, 205))
-east_pac_longitude_points_2025_positive.append((208, 200))
-east_pac_longitude_points_2025_positive.append((167, 195))
-east_pac_longitude_points_2025_positive.append((125, 190))
-east_pac_longitude_points_2025_positive.append((83, 185))
-east_pac_longitude_points_2025_positive.append((42, 180))
-east_pac_longitude_points_2025_positive.append((0, 175)) # Western limit
-
-# Maps the Y coordinate on the image to an associated latitude
-east_pac_latitude_points = []
-east_pac_latitude_points.append((595, 0))  # lower limit
-east_pac_latitude_points.append((533, 5))
-east_pac_latitude_points.append((468, 10))
-east_pac_latitude_points.append((403, 15))
-east_pac_latitude_points.append((335, 20))
-east_pac_latitude_points.append((266, 25))
-east_pac_latitude_points.append((194, 30))
-east_pac_latitude_points.append((118, 35))
-east_pac_latitude_points.append((64, 40))  # upper limit
-
-# These coordinates changed in 2025
-east_pac_latitude_points_2025 = []
-east_pac_latitude_points_2025.append((421, 0))  # lower limit
-east_pac_latitude_points_2025.append((377, 5))
-east_pac_latitude_points_2025.append((334, 10))
-east_pac_latitude_points_2025.append((289, 15))
-east_pac_latitude_points_2025.append((244, 20))
-east_pac_latitude_points_2025.append((197, 25))
-east_pac_latitude_points_2025.append((148, 30))
-east_pac_latitude_points_2025.append((96, 35))
-east_pac_latitude_points_2025.append((64, 40))  # upper limit
-
-
-def get_east_pac_image_latitude_y_pixel(decimal_latitude):
-    return get_image_latitude_y_pixel_with_list(east_pac_latitude_points, decimal_latitude)
-
-def get_east_pac_image_longitude_x_pixel(decimal_longitude):
-    return get_image_longitude_x_pixel_with_list(east_pac_longitude_points, decimal_longitude)
-
-# The epac image dimensions changed in 2025
-def get_east_pac_image_latitude_y_pixel_2025(decimal_latitude):
-    return get_image_latitude_y_pixel_with_list(east_pac_latitude_points_2025, decimal_latitude)
-
-def get_east_pac_image_longitude_x_pixel_2025(decimal_longitude):
-    if decimal_longitude < 0:
-        return get_image_longitude_x_pixel_with_list(east_pac_longitude_points_2025, decimal_longitude)
+                image_draw.text((x_coord, y_coord), f"{max_wind}mph", DRAW_BLACK, font=get_draw_font())
+
+
+# The PNG text key the render digest is stored under, in every output image
+RENDER_DIGEST_KEY = 'nhc-cones-digest'
+
+
+def get_render_settings():
+    return {
+        'addDisclaimerText': addDisclaimerText,
+        'drawOnExtents': drawOnExtents,
+        'useBatchProjection': useBatchProjection,
+        'coneOutlineStyle': coneOutlineStyle,
+        'coneOutlineWidth': coneOutlineWidth,
+        'coneFillColor': list(coneFillColor),
+        'coneFillOpacity': coneFillOpacity,
+        'pngCompressLevel': pngCompressLevel,
+        'pngOptimize': pngOptimize,
+        'usePalettePng': usePalettePng,
+        'pngPaletteColors': pngPaletteColors,
+        'writeWebpVariant': writeWebpVariant,
+        'webpLossless': webpLossless,
+        'webpQuality': webpQuality,
+        'writeLoopAnimation': writeLoopAnimation,
+        'loopFormat': loopFormat,
+        'loopFrameCount': loopFrameCount,
+        'loopDir': loopDir,
+        'loopFrameDuration': loopFrameDuration,
+        'loopLastFrameDuration': loopLastFrameDuration,
+    }
+
+
+# Digest of everything that goes into a render: the base image bytes, the parsed storm geometry and the render settings
+# basin is the registry entry, so editing its control points or text positions also invalidates the render
+def get_render_digest(base_image_file, storm_cache, output_file, basin=None):
+    digest = hashlib.sha256()
+    digest.update(output_file.encode('UTF-8'))
+    if basin is not None:
+        digest.update(json.dumps(basin, sort_keys=True).encode('UTF-8'))
+    with open(base_image_file, 'rb') as base_image:
+        digest.update(base_image.read())
+    storms = [storm_model.get_digest_state() for _, storm_model in sorted(storm_cache.items())]
+    digest.update(json.dumps(storms).encode('UTF-8'))
+    digest.update(json.dumps(get_render_settings(), sort_keys=True).encode('UTF-8'))
+    return digest.hexdigest()
+
+
+# The digest each output was last saved with in this process, so a long-running process doesn't re-open them
+LAST_RENDER_DIGESTS = {}
+
+
+# Checks whether output_file was already rendered from inputs with this digest
+def is_render_current(output_file, digest):
+    from PIL import Image
+    if not skipUnchangedRenders or not os.path.exists(output_file):
+        return False
+    if LAST_RENDER_DIGESTS.get(output_file) == digest:
+        return True
+    try:
+        with Image.open(output_file) as existing:
+            # The digest is written ahead of the image data, so it's normally there without decoding anything
+            existing_digest = existing.info.get(RENDER_DIGEST_KEY)
+            if existing_digest is None:
+                existing.load()
+                existing_digest = existing.info.get(RENDER_DIGEST_KEY)
+    except OSError:
+        return False
+    if existing_digest == digest:
+        LAST_RENDER_DIGESTS[output_file] = digest
+        return True
+    return False
+
+
+# Applies a get_render_settings dict to this process, apply_worker_settings builds on it for worker processes,
+# so they render with this run's settings even when they are spawned rather than forked
+def apply_render_settings(settings):
+    global addDisclaimerText, drawOnExtents, useBatchProjection, coneOutlineStyle, coneOutlineWidth
+    global coneFillColor, coneFillOpacity, pngCompressLevel, pngOptimize, usePalettePng, pngPaletteColors
+    global writeWebpVariant, webpLossless, webpQuality, writeLoopAnimation, loopFormat, loopFrameCount, loopDir
+    global loopFrameDuration, loopLastFrameDuration
+    addDisclaimerText = settings['addDisclaimerText']
+    drawOnExtents = settings['drawOnExtents']
+    useBatchProjection = settings['useBatchProjection']
+    coneOutlineStyle = settings['coneOutlineStyle']
+    coneOutlineWidth = settings['coneOutlineWidth']
+    coneFillColor = tuple(settings['coneFillColor'])
+    coneFillOpacity = settings['coneFillOpacity']
+    pngCompressLevel = settings['pngCompressLevel']
+    pngOptimize = settings['pngOptimize']
+    usePalettePng = settings['usePalettePng']
+    pngPaletteColors = settings['pngPaletteColors']
+    writeWebpVariant = settings['writeWebpVariant']
+    webpLossless = settings['webpLossless']
+    webpQuality = settings['webpQuality']
+    writeLoopAnimation = settings['writeLoopAnimation']
+    loopFormat = settings['loopFormat']
+    loopFrameCount = settings['loopFrameCount']
+    loopDir = settings['loopDir']
+    loopFrameDuration = settings['loopFrameDuration']
+    loopLastFrameDuration = settings['loopLastFrameDuration']
+
+
+# Everything a render worker process reads from the module settings: the render settings, plus the ones that only
+# change how a render is skipped, cached or parsed, so spawned workers don't fall back to the module defaults
+def get_worker_settings():
+    return dict(get_render_settings(),
+                skipUnchangedRenders=skipUnchangedRenders,
+                httpCacheDir=httpCacheDir,
+                useBaseLayerDiskCache=useBaseLayerDiskCache,
+                useStreamingKmlParser=useStreamingKmlParser,
+                basinConfigFile=basinConfigFile,
+                reportEncodingOptions=reportEncodingOptions)
+
+
+# Used as the process pool initializer, with get_worker_settings from the parent process
+def apply_worker_settings(settings):
+    global skipUnchangedRenders, httpCacheDir, useBaseLayerDiskCache, useStreamingKmlParser, basinConfigFile
+    global reportEncodingOptions
+    apply_render_settings(settings)
+    skipUnchangedRenders = settings['skipUnchangedRenders']
+    httpCacheDir = settings['httpCacheDir']
+    useBaseLayerDiskCache = settings['useBaseLayerDiskCache']
+    useStreamingKmlParser = settings['useStreamingKmlParser']
+    basinConfigFile = settings['basinConfigFile']
+    reportEncodingOptions = settings['reportEncodingOptions']
+
+
+# The output encoding settings, with the basin registry entry's "encoding" overrides applied
+def get_basin_encoding(basin=None):
+    encoding = {
+        'compress_level': pngCompressLevel,
+        'optimize': pngOptimize,
+        'palette': usePalettePng,
+        'palette_colors': pngPaletteColors,
+        'webp': writeWebpVariant,
+        'webp_lossless': webpLossless,
+        'webp_quality': webpQuality,
+    }
+    if basin is not None:
+        encoding.update(basin.get('encoding') or {})
+    return encoding
+
+
+# Named encodings compared by reportEncodingOptions, as (format, palette colors or None, Pillow save options)
+ENCODING_OPTIONS = {
+    'png': ('PNG', None, {'compress_level': 6}),
+    'png_fast': ('PNG', None, {'compress_level': 1}),
+    'png_optimize': ('PNG', None, {'optimize': True}),
+    'png_palette': ('PNG', 256, {'compress_level': 6}),
+    'png_palette_optimize': ('PNG', 256, {'optimize': True}),
+    'webp_lossless': ('WEBP', None, {'lossless': True}),
+    'webp_q80': ('WEBP', None, {'quality': 80}),
+}
+
+
+# Reduces an RGB image to a palette image of at most colors colors
+# Fast octree without dithering keeps the flat map colors flat, and is quicker than the default median cut
+def quantize_image(image, colors):
+    from PIL import Image
+    return image.quantize(colors, method=Image.FASTOCTREE, dither=Image.NONE)
+
+
+def get_webp_variant_file(output_file):
+    return path.splitext(output_file)[0] + '.webp'
+
+
+# Encodes the image the way encoding says (see get_basin_encoding), to output_file and its WebP variant if enabled
+# Each encode's time and size go in the run metrics, as png_encode/png_bytes and webp_encode/webp_bytes
+# metric_labels defaults to just the basin, resized outputs also carry their width
+def save_rendered_image(image, output_file, digest, basin=None, encoding=None, metric_labels=None):
+    from PIL import PngImagePlugin
+    encoding = encoding or get_basin_encoding()
+    png_info = PngImagePlugin.PngInfo()
+    png_info.add_text(RENDER_DIGEST_KEY, digest)
+    if metric_labels is None:
+        metric_labels = {'basin': basin} if basin else {}
+    with timed_stage('png_encode', **metric_labels):
+        png_image = quantize_image(image, encoding['palette_colors']) if encoding['palette'] else image
+        png_image.save(output_file, format='PNG', pnginfo=png_info, compress_level=encoding['compress_level'],
+                       optimize=encoding['optimize'])
+    increment_counter('png_bytes', os.path.getsize(output_file), **metric_labels)
+    if encoding['webp']:
+        webp_file = get_webp_variant_file(output_file)
+        with timed_stage('webp_encode', **metric_labels):
+            image.save(webp_file, format='WEBP', lossless=encoding['webp_lossless'], quality=encoding['webp_quality'])
+        increment_counter('webp_bytes', os.path.getsize(webp_file), **metric_labels)
+    LAST_RENDER_DIGESTS[output_file] = digest
+
+
+# The file a basin's resized output is saved as, from the size's file_name template
+# The template can use {name} (the basin), {stem} and {ext} (of the basin's output file) and {width}
+def get_sized_output_file(basin, size):
+    stem, ext = path.splitext(basin['output_file'])
+    return size['file_name'].format(name=basin['name'], stem=stem, ext=ext, width=size['width'])
+
+
+# Produces every output_sizes entry of the basin from the rendered image, largest first
+# Each step halves the previous level with a box reduce while it stays at least twice the target width, then a
+# single Lanczos resize lands on the exact size, so no level is filtered down from the full image in one go
+# Sizes wider than the render are upscaled from it directly
+def save_output_sizes(image, basin, digest, encoding):
+    from PIL import Image
+    level = image
+    for size in sorted(basin['output_sizes'], key=lambda size: size['width'], reverse=True):
+        metric_labels = {'basin': basin['name'], 'width': str(size['width'])}
+        with timed_stage('resize', **metric_labels):
+            if size['width'] > image.size[0]:
+                level = image
+            while level.size[0] >= size['width'] * 2:
+                level = level.reduce(2)
+            height = max(1, round(image.size[1] * size['width'] / image.size[0]))
+            sized_image = level if level.size == (size['width'], height) else level.resize((size['width'], height),
+                                                                                          Image.LANCZOS)
+        save_rendered_image(sized_image, get_sized_output_file(basin, size), digest, encoding=encoding,
+                            metric_labels=metric_labels)
+
+
+# Encodes the image in memory with every ENCODING_OPTIONS entry, and reports how long each took and how big it came out
+# Recorded in the run metrics as the encode_option stage and encoded_bytes counter, labelled with the option name
+def report_encoding_options(image, basin=None):
+    metric_labels = {'basin': basin} if basin else {}
+    for option, (image_format, palette_colors, save_options) in ENCODING_OPTIONS.items():
+        encoded = io.BytesIO()
+        start = time.perf_counter()
+        (quantize_image(image, palette_colors) if palette_colors else image).save(encoded, format=image_format,
+                                                                                 **save_options)
+        duration = time.perf_counter() - start
+        record_stage_duration('encode_option', duration, option=option, **metric_labels)
+        increment_counter('encoded_bytes', encoded.tell(), option=option, **metric_labels)
+        print(f"{basin or ''} {option}: {encoded.tell()} bytes in {duration * 1000:.1f} ms")
+
+
+# The basins (and any other products) read from basinConfigFile, each entry as loaded by load_basin_registry
+BASIN_REGISTRY = None
+# Every basin entry needs these, longitude_points_positive, enabled, encoding and output_sizes are optional
+# A basin without output_sizes uses the top level output_sizes list, each size is {"file_name": ..., "width": ...}
+# text_locations colors are 'black', 'white' or an [r, g, b] list
+BASIN_REQUIRED_KEYS = ('name', 'base_image_url', 'output_file', 'storm_prefixes', 'timezone', 'timestamp_position',
+                       'text_locations', 'latitude_points', 'longitude_points')
+TEXT_COLORS = {'black': DRAW_BLACK, 'white': DRAW_WHITE}
+
+
+# Reads the basin registry, a relative config_file is found next to this script
+# Control points become lists of (pixel, degrees) tuples, text colors become RGB tuples,
+# and base_image_file is the name the base image is downloaded to
+def load_basin_registry(config_file=None):
+    config_file = config_file or basinConfigFile
+    if not path.isabs(config_file):
+        config_file = path.join(path.dirname(path.abspath(__file__)), config_file)
+    with open(config_file, 'r') as config_in:
+        config = json.load(config_in)
+    basins = []
+    for entry in config['basins']:
+        missing = [key for key in BASIN_REQUIRED_KEYS if key not in entry]
+        if missing:
+            raise ValueError(f"Basin {entry.get('name')!r} in {config_file} is missing {', '.join(missing)}")
+        basin = dict(entry)
+        basin['enabled'] = entry.get('enabled', True)
+        basin['timestamp_position'] = tuple(entry['timestamp_position'])
+        basin['text_locations'] = [(x, y, TEXT_COLORS[color] if isinstance(color, str) else tuple(color))
+                                   for x, y, color in entry['text_locations']]
+        basin['latitude_points'] = [tuple(point) for point in entry['latitude_points']]
+        basin['longitude_points'] = [tuple(point) for point in entry['longitude_points']]
+        if entry.get('longitude_points_positive'):
+            basin['longitude_points_positive'] = [tuple(point) for point in entry['longitude_points_positive']]
+        else:
+            basin['longitude_points_positive'] = None
+        basin['output_sizes'] = entry.get('output_sizes', config.get('output_sizes', []))
+        basin['base_image_file'] = path.basename(urlparse(entry['base_image_url']).path)
+        basins.append(basin)
+    return basins
+
+
+# The enabled basins, loading the registry on first use
+def get_basins():
+    global BASIN_REGISTRY
+    if BASIN_REGISTRY is None:
+        BASIN_REGISTRY = load_basin_registry()
+    return [basin for basin in BASIN_REGISTRY if basin['enabled']]
+
+
+def get_basin_image_latitude_y_pixel(basin, decimal_latitude):
+    return get_image_latitude_y_pixel_with_list(basin['latitude_points'], decimal_latitude)
+
+
+# Maps with a positive longitude list (the ones crossing the antimeridian) use it east of 180
+def get_basin_image_longitude_x_pixel(basin, decimal_longitude):
+    if basin['longitude_points_positive'] is not None and decimal_longitude >= 0:
+        return get_image_longitude_x_pixel_with_list(basin['longitude_points_positive'], decimal_longitude)
+    return get_image_longitude_x_pixel_with_list(basin['longitude_points'], decimal_longitude)
+
+
+def get_basin_image_latitude_y_pixels(basin, decimal_latitudes):
+    return get_image_latitude_y_pixels_with_list(basin['latitude_points'], decimal_latitudes)
+
+
+def get_basin_image_longitude_x_pixels(basin, decimal_longitudes):
+    if basin['longitude_points_positive'] is not None:
+        return get_image_longitude_x_pixels_with_split_lists(basin['longitude_points'],
+                                                             basin['longitude_points_positive'], decimal_longitudes)
+    return get_image_longitude_x_pixels_with_list(basin['longitude_points'], decimal_longitudes)
+
+
+def get_basin_viewport(basin):
+    longitude_lists = [basin['longitude_points']]
+    if basin['longitude_points_positive'] is not None:
+        longitude_lists.append(basin['longitude_points_positive'])
+    return get_viewport_with_lists(basin['latitude_points'], *longitude_lists)
+
+
+# The modify_image projection arguments for a basin, as (lat_func, long_func, lat_batch_func, long_batch_func, viewport)
+def get_basin_projections(basin):
+    return (functools.partial(get_basin_image_latitude_y_pixel, basin),
+            functools.partial(get_basin_image_longitude_x_pixel, basin),
+            functools.partial(get_basin_image_latitude_y_pixels, basin),
+            functools.partial(get_basin_image_longitude_x_pixels, basin),
+            get_basin_viewport(basin))
+
+
+# Renders one registry entry from its downloaded base image
+# advisory_time (an aware datetime) is stamped on the map instead of the current time, for archive mode
+# Returns True if the basin's output file was regenerated, False if it was already up to date
+def render_basin(basin, storm_cache=None, advisory_time=None):
+    from PIL import ImageDraw
+    import pytz
+    if storm_cache is None:
+        storm_cache = build_storm_cache()
+    name = basin['name']
+    output_file = basin['output_file']
+    digest = get_render_digest(basin['base_image_file'], storm_cache, output_file, basin)
+    variants_exist = all(os.path.exists(file) for file in get_basin_output_files(basin))
+    if variants_exist and is_render_current(output_file, digest):
+        print(f"{output_file} is up to date, skipping render")
+        increment_counter('renders_skipped', basin=name)
+        return False
+    basin_timezone = pytz.timezone(basin['timezone'])
+    if advisory_time is not None:
+        now_time_loc = advisory_time.astimezone(basin_timezone)
     else:
-        return get_image_longitude_x_pixel_with_list(east_pac_longitude_points_2025_positive, decimal_longitude)
-
-
-
-east_pac_text_locations = []
-east_pac_text_locations.append((20, 40, DRAW_BLACK))
-east_pac_text_locations.append((700, 40, DRAW_BLACK))
-east_pac_text_locations.append((35, 500, DRAW_WHITE))
-east_pac_text_locations.append((35, 100, DRAW_WHITE))
-east_pac_text_locations.append((720, 410, DRAW_WHITE))
-
-
-def do_mod_east_pac_image():
-    pacific = pytz.timezone('US/Pacific')
-    now_time_loc = datetime.datetime.now(pacific)
+        now_time_loc = datetime.datetime.now(basin_timezone)
     time_string = now_time_loc.strftime("!! %I:%M %p %Z !!")
     date_string = now_time_loc.strftime("!! %a %b %d %Y !!")
-    with Image.open('two_pac_7d0.png').convert('RGB') as image:
+    with open_prepared_base_image(basin) as image:
         draw = ImageDraw.Draw(image)
-        remove_logos_and_add_unofficial_text(draw, east_pac_text_locations)
-        # Add time and date the image was generated
-        draw.text((35, 130), time_string, (255, 255, 255), font=DRAW_FONT)
-        draw.text((35, 145), date_string, (255, 255, 255), font=DRAW_FONT)
-        modify_image(image, get_east_pac_image_latitude_y_pixel_2025, get_east_pac_image_longitude_x_pixel_2025)
-
-        # testing coordinate generation
-        # for longitude in range(0, 45):
-        #     longitude = -145 + (longitude * 2.5)
-        #
-        #     x_coord = bound_x_to_image(image.size[0], get_east_pac_image_longitude_x_pixel(longitude))
-        #     print("longitude: ", longitude, " x_coord: ", x_coord)
-        #     for latitude in range(0, 20):
-        #         latitude = latitude * 2.5
-        #         y_coord = get_east_pac_image_latitude_y_pixel(latitude)
-        #         # print("latitude ", latitude, " gave y_coord: ", y_coord)
-        #         image.putpixel((x_coord, y_coord), (0, 0, 0, 255))
-        image.save('epac_latest.png')
-
-
-# Maps the X coordinate on the image to an associated longitude
-# From -180 to -120
-cpac_longitude_points_negative = []
-cpac_longitude_points_negative.append((899, -120))  # Eastern limit
-cpac_longitude_points_negative.append((839, -125))
-cpac_longitude_points_negative.append((774, -130))
-cpac_longitude_points_negative.append((709, -135))
-cpac_longitude_points_negative.append((644, -140))
-cpac_longitude_points_negative.append((579, -145))
-cpac_longitude_points_negative.append((514, -150))
-cpac_longitude_points_negative.append((449, -155))
-cpac_longitude_points_negative.append((384, -160))
-cpac_longitude_points_negative.append((319, -165))
-cpac_longitude_points_negative.append((255, -170))
-cpac_longitude_points_negative.append((190, -175))
-cpac_longitude_points_negative.append((125, -180))  # Western limit
-
-# From +170 to +205
-cpac_longitude_points_positive = []
-cpac_longitude_points_positive.append((899, 240))   # Eastern limit (Updated July 2025)
-cpac_longitude_points_positive.append((839, 235))
-cpac_longitude_points_positive.append((774, 230))
-cpac_longitude_points_positive.append((709, 225))
-cpac_longitude_points_positive.append((644, 220))
-cpac_longitude_points_positive.append((579, 215))
-cpac_longitude_points_positive.append((514, 210))
-cpac_longitude_points_positive.append((449, 205))
-cpac_longitude_points_positive.append((385, 200))
-cpac_longitude_points_positive.append((320, 195))
-cpac_longitude_points_positive.append((255, 190))
-cpac_longitude_points_positive.append((190, 185))
-cpac_longitude_points_positive.append((125, 180))
-cpac_longitude_points_positive.append((60, 175))
-cpac_longitude_points_positive.append((0, 170))  # Western limit
-
-# Maps the Y coordinate on the image to an associated latitude
-# Updated July 2025 for accuracy
-cpac_latitude_points = []
-cpac_latitude_points.append((587, 0))  # lower limit
-cpac_latitude_points.append((534, 5))
-cpac_latitude_points.append((469, 10))
-cpac_latitude_points.append((403, 15))
-cpac_latitude_points.append((336, 20))
-cpac_latitude_points.append((266, 25))
-cpac_latitude_points.append((193, 30))
-cpac_latitude_points.append((117, 35))
-cpac_latitude_points.append((64, 40))  # upper limit
-
-
-def get_cpac_image_latitude_y_pixel(decimal_latitude):
-    return get_image_latitude_y_pixel_with_list(cpac_latitude_points, decimal_latitude)
-
-
-def get_cpac_image_longitude_x_pixel(decimal_longitude):
-    if decimal_longitude < 0:
-        return get_image_longitude_x_pixel_with_list(cpac_longitude_points_negative, decimal_longitude)
-    else:
-        return get_image_longitude_x_pixel_with_list(cpac_longitude_points_positive, decimal_longitude)
-
 
-cpac_text_locations = []
-cpac_text_locations.append((20, 40, DRAW_BLACK))
-cpac_text_locations.append((700, 40, DRAW_BLACK))
-cpac_text_locations.append((15, 500, DRAW_WHITE))
-cpac_text_locations.append((700, 150, DRAW_WHITE))
-cpac_text_locations.append((700, 540, DRAW_WHITE))
+        # Add time and date the image was generated, the date on the line below the time
+        time_x, time_y = basin['timestamp_position']
+        draw.text((time_x, time_y), time_string, (255, 255, 255), font=get_draw_font())
+        draw.text((time_x, time_y + 15), date_string, (255, 255, 255), font=get_draw_font())
+        lat_func, long_func, lat_batch_func, long_batch_func, viewport = get_basin_projections(basin)
+        modify_image(image, lat_func, long_func, storm_cache, lat_batch_func, long_batch_func, viewport, name)
+        save_rendered_image(image, output_file, digest, name, get_basin_encoding(basin))
+        save_output_sizes(image, basin, digest, get_basin_encoding(basin))
+        if is_loop_enabled(basin):
+            with timed_stage('loop_encode', basin=name):
+                append_loop_frame(basin, image)
+        if reportEncodingOptions:
+            with timed_stage('encoding_report', basin=name):
+                report_encoding_options(image, name)
+    return True
+
+
+# Every file render_basin writes for a basin, its output file first
+def get_basin_output_files(basin):
+    output_files = [basin['output_file']] + [get_sized_output_file(basin, size) for size in basin['output_sizes']]
+    if get_basin_encoding(basin)['webp']:
+        output_files += [get_webp_variant_file(output_file) for output_file in output_files]
+    if is_loop_enabled(basin):
+        output_files.append(get_loop_file(basin))
+    return output_files
+
+
+def is_loop_enabled(basin):
+    return writeLoopAnimation and basin.get('loop', True)
+
+
+def get_loop_file(basin):
+    return path.splitext(basin['output_file'])[0] + ('_loop.png' if loopFormat == 'apng' else '_loop.gif')
+
+
+# Each basin's loop keeps its last loopFrameCount frames in loopDir/<basin name>:
+# ring.json (format, size, frame sequence numbers), palette.png (the palette every frame is mapped to),
+# last_frame.png (the newest frame, to diff the next one against), and two encoded records per frame,
+# <seq>.key holding the whole frame and <seq>.delta only the rectangle that changed since the frame before it
+# A record is the rectangle's x, y, width and height as little endian 16 bit values, then the encoded pixels
+# (GIF LZW sub-blocks, or the zlib stream of PNG IDAT data for APNG)
+def get_loop_ring_dir(basin):
+    return path.join(loopDir, basin['name'])
+
+
+def read_loop_state(ring_dir):
+    try:
+        with open(path.join(ring_dir, 'ring.json'), 'r') as state_in:
+            return json.load(state_in)
+    except (OSError, ValueError):
+        return None
 
 
-def do_mod_cpac_image():
-    hawaii = pytz.timezone('US/Hawaii')
-    now_time_loc = datetime.datetime.now(hawaii)
-    time_string = now_time_loc.strftime("!! %I:%M %p %Z !!")
-    date_string = now_time_loc.strftime("!! %a %b %d %Y !!")
-    with Image.open('two_cpac_7d0.png').convert('RGB') as image:
-        draw = ImageDraw.Draw(image)
-        remove_logos_and_add_unofficial_text(draw, cpac_text_locations)
-        # Add time and date the image was generated
-        draw.text((700, 165), time_string, (255, 255, 255), font=DRAW_FONT)
-        draw.text((700, 180), date_string, (255, 255, 255), font=DRAW_FONT)
-        modify_image(image, get_cpac_image_latitude_y_pixel, get_cpac_image_longitude_x_pixel)
-
-        # testing coordinate generation
-        # for longitude in range(0, 45):
-        #    longitude = -180 + (longitude * 2.5)
-        #    x_coord = bound_x_to_image(image.size[0], get_cpac_image_longitude_x_pixel(longitude))
-        #    print("longitude: ", longitude, " x_coord: ", x_coord)
-        #    for latitude in range(0, 20):
-        #        latitude = latitude * 2.5
-        #        y_coord = get_cpac_image_latitude_y_pixel(latitude)
-        #        # print("latitude ", latitude, " gave y_coord: ", y_coord)
-        #        image.putpixel((x_coord, y_coord), (0, 0, 0, 255))
-        # for longitude in range(0, 4):
-        #     longitude = 170 + (longitude * 2.5)
-        #     x_coord = bound_x_to_image(image.size[0], get_cpac_image_longitude_x_pixel(longitude))
-        #     print("longitude: ", longitude, " x_coord: ", x_coord)
-        #     for latitude in range(0, 20):
-        #        latitude = latitude * 2.5
-        #        y_coord = get_cpac_image_latitude_y_pixel(latitude)
-        #        # print("latitude ", latitude, " gave y_coord: ", y_coord)
-        #        image.putpixel((x_coord, y_coord), (0, 0, 0, 255))
-        image.save('cpac_latest.png')
+def write_loop_state(ring_dir, state):
+    state_file = path.join(ring_dir, 'ring.json')
+    with open(f"{state_file}.tmp", 'w') as out:
+        json.dump(state, out)
+    os.replace(f"{state_file}.tmp", state_file)
+
+
+# The encoded pixels of a palette image, cut out of what Pillow writes for it
+def encode_loop_pixels(frame_image):
+    import struct
+    buffer = io.BytesIO()
+    if loopFormat == 'apng':
+        frame_image.save(buffer, format='PNG', bits=8)
+        data = buffer.getvalue()
+        pos = 8
+        idat_parts = []
+        while pos < len(data):
+            length, chunk_type = struct.unpack('>I4s', data[pos:pos + 8])
+            if chunk_type == b'IDAT':
+                idat_parts.append(data[pos + 8:pos + 8 + length])
+            pos += length + 12
+        return b''.join(idat_parts)
+    frame_image.save(buffer, format='GIF', optimize=False, interlace=False)
+    data = buffer.getvalue()
+    # Skip the header, logical screen descriptor and global color table, then any extensions
+    pos = 13 + (3 * 2 ** ((data[10] & 7) + 1) if data[10] & 0x80 else 0)
+    while data[pos] == 0x21:
+        pos += 2
+        while data[pos]:
+            pos += data[pos] + 1
+        pos += 1
+    # Then the image descriptor and its local color table, if any
+    pos += 10 + (3 * 2 ** ((data[pos + 9] & 7) + 1) if data[pos + 9] & 0x80 else 0)
+    start = pos
+    # LZW minimum code size, then data sub-blocks up to the empty one
+    pos += 1
+    while data[pos]:
+        pos += data[pos] + 1
+    return data[start:pos + 1]
+
+
+def encode_loop_record(frame_image, box):
+    import struct
+    left, top, right, bottom = box
+    return struct.pack('<4H', left, top, right - left, bottom - top) + encode_loop_pixels(frame_image.crop(box))
+
+
+# The rectangle of frame_image that differs from previous_image, as a crop box
+def get_changed_box(previous_image, frame_image):
+    import numpy as np
+    changed = np.asarray(previous_image) != np.asarray(frame_image)
+    if not changed.any():
+        return 0, 0, 1, 1
+    rows = np.flatnonzero(changed.any(axis=1))
+    columns = np.flatnonzero(changed.any(axis=0))
+    return int(columns[0]), int(rows[0]), int(columns[-1]) + 1, int(rows[-1]) + 1
+
+
+# Adds a render to the basin's loop and rewrites the loop file
+# The new frame is mapped to the loop's shared palette and encoded twice, whole and as a delta, and the file is then
+# stitched together from the stored records without re-encoding the older frames,
+# so the work per frame doesn't grow with loopFrameCount
+def append_loop_frame(basin, image):
+    from PIL import Image
+    ring_dir = get_loop_ring_dir(basin)
+    os.makedirs(ring_dir, exist_ok=True)
+    palette_file = path.join(ring_dir, 'palette.png')
+    last_frame_file = path.join(ring_dir, 'last_frame.png')
+    state = read_loop_state(ring_dir)
+    if state is None or state['format'] != loopFormat or tuple(state['size']) != image.size:
+        # New loop, or the format or base map size changed: start over with a palette made from this frame
+        for file in os.listdir(ring_dir):
+            os.remove(path.join(ring_dir, file))
+        state = {'format': loopFormat, 'size': list(image.size), 'next_seq': 0, 'frames': []}
+        palette_image = quantize_image(image, 256)
+        palette_image.save(palette_file)
+    else:
+        with Image.open(palette_file) as palette_in:
+            palette_image = palette_in.copy()
+    frame_image = image.quantize(palette=palette_image, dither=Image.NONE)
+    seq = state['next_seq']
+    full_box = (0, 0) + image.size
+    with open(path.join(ring_dir, f"{seq}.key"), 'wb') as out:
+        out.write(encode_loop_record(frame_image, full_box))
+    if state['frames']:
+        with Image.open(last_frame_file) as previous_in:
+            delta_box = get_changed_box(previous_in, frame_image)
+    else:
+        delta_box = full_box
+    with open(path.join(ring_dir, f"{seq}.delta"), 'wb') as out:
+        out.write(encode_loop_record(frame_image, delta_box))
+    frame_image.save(last_frame_file)
+    state['frames'].append(seq)
+    state['next_seq'] = seq + 1
+    # The frame after the oldest one only ever needs its delta, the oldest one is written whole
+    while len(state['frames']) > loopFrameCount:
+        dropped = state['frames'].pop(0)
+        for suffix in ('key', 'delta'):
+            os.remove(path.join(ring_dir, f"{dropped}.{suffix}"))
+    write_loop_state(ring_dir, state)
+    write_loop_file(ring_dir, state, palette_image, get_loop_file(basin))
+
+
+# Writes the loop from its stored records: the oldest frame whole, every later one as its delta, drawn over the
+# frames before it
+def write_loop_file(ring_dir, state, palette_image, loop_file):
+    import struct
+    import zlib
+    palette = bytes((palette_image.getpalette() + [0] * 768)[:768])
+    width, height = state['size']
+    frames = state['frames']
+
+    def write_chunk(out, chunk_type, data):
+        out.write(struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data)))
+
+    with open(f"{loop_file}.tmp", 'wb') as out:
+        if loopFormat == 'apng':
+            out.write(b'\x89PNG\r\n\x1a\n')
+            write_chunk(out, b'IHDR', struct.pack('>2I5B', width, height, 8, 3, 0, 0, 0))
+            write_chunk(out, b'acTL', struct.pack('>2I', len(frames), 0))
+            write_chunk(out, b'PLTE', palette)
+        else:
+            # Global color table of 256 entries, then loop forever
+            out.write(b'GIF89a' + struct.pack('<2H3B', width, height, 0xF7, 0, 0) + palette)
+            out.write(b'\x21\xFF\x0BNETSCAPE2.0\x03\x01\x00\x00\x00')
+        sequence = 0
+        for index, seq in enumerate(frames):
+            with open(path.join(ring_dir, f"{seq}.{'key' if index == 0 else 'delta'}"), 'rb') as record_in:
+                record = record_in.read()
+            left, top, frame_width, frame_height = struct.unpack('<4H', record[:8])
+            duration = loopLastFrameDuration if index == len(frames) - 1 else loopFrameDuration
+            if loopFormat == 'apng':
+                write_chunk(out, b'fcTL', struct.pack('>5I2H2B', sequence, frame_width, frame_height, left, top,
+                                                      duration, 1000, 0, 0))
+                sequence += 1
+                if index == 0:
+                    write_chunk(out, b'IDAT', record[8:])
+                else:
+                    write_chunk(out, b'fdAT', struct.pack('>I', sequence) + record[8:])
+                    sequence += 1
+            else:
+                # Graphic control extension (leave the frame in place, delay in hundredths), then the image
+                out.write(struct.pack('<4BH2B', 0x21, 0xF9, 4, 0x04, round(duration / 10), 0, 0))
+                out.write(struct.pack('<B4HB', 0x2C, left, top, frame_width, frame_height, 0) + record[8:])
+        if loopFormat == 'apng':
+            write_chunk(out, b'IEND', b'')
+        else:
+            out.write(b'\x3B')
+    os.replace(f"{loop_file}.tmp", loop_file)
+    increment_counter('loop_bytes', os.path.getsize(loop_file))
 
 
 # Function:     kmz_to_kml
@@ -617,6 +1797,7 @@ def do_mod_cpac_image():
 # Purpose: convert kmz to kml base script
 def kmz_to_kml(fname):
     """save kmz to kml"""
+    from xml.dom import minidom
     zf = zipfile.ZipFile(fname, 'r')
     for fn in zf.namelist():
         if fn.endswith('.kml'):
@@ -628,90 +1809,518 @@ def kmz_to_kml(fname):
             out.close()
 
 
-def main():
-    # scrape_page args:
-    # Atlantic which_td = 2
-    # Eastern Pacific which_td = 3
-    # Central Pacific which_td = 4
+# Reads the KML member straight out of the KMZ and parses it once, in memory
+# No .kml file is written, unlike kmz_to_kml
+def read_kml_root_from_kmz(fname):
+    with zipfile.ZipFile(fname, 'r') as zf:
+        for fn in zf.namelist():
+            if fn.endswith('.kml'):
+                return ET.fromstring(zf.read(fn))
+    raise ValueError(f"No .kml member found in {fname}")
+
+
+# Renders a basin in a worker process, and sends the worker's metrics back along with its result
+def render_basin_in_worker(basin, storm_cache):
+    reset_run_metrics()
+    with timed_stage('render', basin=basin['name']):
+        result = render_basin(basin, storm_cache)
+    return result, RUN_METRICS
+
+
+# Renders each registry entry against the shared storm cache
+# Returns the output files that were regenerated
+def render_basins(basins, storm_cache):
+    regenerated = []
+    if renderBasinsInProcessPool and len(basins) > 1:
+        with ProcessPoolExecutor(max_workers=renderMaxWorkers, initializer=apply_worker_settings,
+                                 initargs=(get_worker_settings(),)) as executor:
+            futures = [(basin, executor.submit(render_basin_in_worker, basin, storm_cache)) for basin in basins]
+            for basin, future in futures:
+                result, worker_metrics = future.result()
+                merge_run_metrics(worker_metrics)
+                if result:
+                    regenerated += get_basin_output_files(basin)
+    else:
+        for basin in basins:
+            with timed_stage('render', basin=basin['name']):
+                if render_basin(basin, storm_cache):
+                    regenerated += get_basin_output_files(basin)
+    return regenerated
+
+
+def get_output_files():
+    return [output_file for basin in get_basins() for output_file in get_basin_output_files(basin)]
+
+
+# The storm products the basins draw, from the manifest, as (storm id, product, url)
+def get_basin_products(basins, manifest):
+    storm_prefixes = [prefix for basin in basins for prefix in basin['storm_prefixes']]
+    return get_manifest_products(manifest, storm_prefixes)
+
+
+# Everything the basins need downloaded: their storm products, then their base images, each listed once
+def get_basin_urls(basins, manifest=None):
+    manifest = manifest or get_product_manifest()
+    urls = [url for _, _, url in get_basin_products(basins, manifest)]
+    urls += dict.fromkeys(basin['base_image_url'] for basin in basins)
+    return urls
+
+
+# Downloads everything the basins need, returns their storm products as (storm id, product, local kmz file)
+def fetch_basin_assets(basins, manifest):
+    products = get_basin_products(basins, manifest)
+    fetch_files(get_basin_urls(basins, manifest))
+    return [(storm, product, path.basename(urlparse(url).path)) for storm, product, url in products]
+
+
+def clean_up_downloads(basins=None):
+    for file in glob.glob("*.km*"):
+        os.remove(file)
+    for base_image_file in dict.fromkeys(basin['base_image_file'] for basin in basins or get_basins()):
+        try:
+            os.remove(base_image_file)
+        except:
+            pass
+
+
+# Where the fingerprint of the last run's inputs is kept, alongside the HTTP cache so it persists with it
+def get_run_state_file():
+    return path.join(httpCacheDir, 'last_run.json')
+
+
+# Fingerprint of everything fetched this run, the render settings, the basin registry entries and the outputs
+# being produced, so editing basins.json (control points, text positions, encoding...) re-renders too
+def get_input_fingerprint(output_files):
+    fingerprint = hashlib.sha256()
+    fingerprint.update(json.dumps(sorted(RUN_FETCHED_DIGESTS.items())).encode('UTF-8'))
+    fingerprint.update(json.dumps(get_render_settings(), sort_keys=True).encode('UTF-8'))
+    fingerprint.update(json.dumps(get_basins(), sort_keys=True).encode('UTF-8'))
+    fingerprint.update(json.dumps(output_files).encode('UTF-8'))
+    return fingerprint.hexdigest()
+
+
+def is_run_unchanged(input_fingerprint, output_files):
+    if not skipUnchangedRenders or not os.path.exists(get_run_state_file()):
+        return False
+    if not all(os.path.exists(output_file) for output_file in output_files):
+        return False
+    try:
+        with open(get_run_state_file(), 'r') as state_in:
+            return json.load(state_in).get('input_fingerprint') == input_fingerprint
+    except (OSError, ValueError):
+        return False
+
+
+def save_run_state(input_fingerprint):
+    os.makedirs(path.dirname(get_run_state_file()), exist_ok=True)
+    with open(f"{get_run_state_file()}.tmp", 'w') as out:
+        json.dump({'input_fingerprint': input_fingerprint}, out)
+    os.replace(f"{get_run_state_file()}.tmp", get_run_state_file())
+
+
+# One pass of the whole pipeline: fetch, parse, render and clean up
+# Returns the output files that were regenerated
+def run_pipeline():
+    regenerated = []
+    RUN_FETCHED_DIGESTS.clear()
+    start_fetch_deadline()
+    basins = get_basins()
+    # The GIS page is fetched and parsed once, every basin works from its manifest
+    with timed_stage('fetch', product='gis_page'):
+        manifest = get_product_manifest()
 
     if not drawConesWhenTheyOverlapRegions:
-        if generateAtlantic:
-            # Atlantic
-            scrape_page(2)
-            get_latest_base_image('https://www.nhc.noaa.gov/xgtwo/two_atl_7d0.png')
-            do_mod_atl_image()
+        for basin in basins:
+            with timed_stage('fetch', basin=basin['name']):
+                products = fetch_basin_assets([basin], manifest)
+            regenerated += render_basins([basin], build_storm_cache_from_products(products))
             # clean up
             if cleanUpFiles:
-                for file in glob.glob("*.km*"):
-                    os.remove(file)
-                os.remove("two_atl_7d0.png")
-
-        if generateEasternPacific:
-            # Eastern Pacific
-            scrape_page(3)
-            get_latest_base_image('https://www.nhc.noaa.gov/xgtwo/two_pac_7d0.png')
-            do_mod_east_pac_image()
-            # clean up
-            if cleanUpFiles:
-                for file in glob.glob("*.km*"):
-                    os.remove(file)
-                os.remove("two_pac_7d0.png")
-
-        if generateCentralPacific:
-            # Central Pacific
-            scrape_page(4)
-            get_latest_base_image('https://www.nhc.noaa.gov/xgtwo/two_cpac_7d0.png')
-            do_mod_cpac_image()
-            # clean up
-            if cleanUpFiles:
-                for file in glob.glob("*.km*"):
-                    os.remove(file)
-                os.remove("two_cpac_7d0.png")
+                clean_up_downloads([basin])
     else:
-        if generateAtlantic:
-            # Atlantic
-            scrape_page(2, False)
-            get_latest_base_image('https://www.nhc.noaa.gov/xgtwo/two_atl_7d0.png')
+        with timed_stage('fetch'):
+            # Gather every basin's assets, then download them all in a single batch
+            products = fetch_basin_assets(basins, manifest)
+
+        output_files = get_output_files()
+        # Fast path: the exact same inputs as the last run, and its outputs are still in place
+        # Exits before parsing anything, or importing the imaging libraries
+        input_fingerprint = get_input_fingerprint(output_files)
+        if is_run_unchanged(input_fingerprint, output_files):
+            print("Nothing changed since the last run")
+            increment_counter('runs_unchanged')
+            if cleanUpFiles:
+                clean_up_downloads(basins)
+            return regenerated
+
+        # Parse every storm once, and share it with every basin
+        with timed_stage('parse'):
+            storm_cache = build_storm_cache_from_products(products)
+        regenerated += render_basins(basins, storm_cache)
+        save_run_state(input_fingerprint)
+
+        # Clean up
+        if cleanUpFiles:
+            clean_up_downloads(basins)
+    increment_counter('outputs_regenerated', len(regenerated))
+    return regenerated
 
-        if generateEasternPacific:
-            # Eastern Pacific
-            scrape_page(3, False)
-            get_latest_base_image('https://www.nhc.noaa.gov/xgtwo/two_pac_7d0.png')
 
-        if generateCentralPacific:
-            # Central Pacific
-            scrape_page(4, False)
-            get_latest_base_image('https://www.nhc.noaa.gov/xgtwo/two_cpac_7d0.png')
+def main():
+    reset_run_metrics()
+    with timed_stage('total'):
+        regenerated = run_pipeline()
 
+    if regenerated:
+        print("Regenerated: ", ", ".join(regenerated))
+    else:
+        print("No outputs changed")
+    write_metrics_report()
+
+
+# Stays resident and runs the pipeline every interval seconds, with jitter
+# Parsed storms, decoded base images, the font and the projection tables stay in memory between polls,
+# and only basins whose inputs changed are re-rendered
+# A failed poll is retried after daemonRetryDelay seconds, doubling on each consecutive failure
+# on_poll, if given, is called with the list of regenerated outputs after every successful poll
+def run_daemon(interval=None, on_poll=None):
+    interval = interval or daemonPollInterval
+    failures = 0
+    while True:
+        reset_run_metrics()
+        try:
+            with timed_stage('total'):
+                regenerated = run_pipeline()
+            if regenerated:
+                print("Regenerated: ", ", ".join(regenerated))
+            else:
+                print("No outputs changed")
+            write_metrics_report()
+            if on_poll is not None:
+                on_poll(regenerated)
+            failures = 0
+            delay = interval
+        except Exception as e:
+            failures += 1
+            delay = min(daemonMaxBackoff, daemonRetryDelay * (2 ** (failures - 1)))
+            print(f"WARNING: Poll failed ({failures} in a row): {e!r}")
+        delay *= random.uniform(1 - daemonJitter, 1 + daemonJitter)
+        print(f"Next poll in {delay:.0f} seconds")
+        time.sleep(delay)
+
+
+# The latest rendered images, encoded and held in memory for serve mode
+# Maps the URL path (e.g. '/atl_latest.png') to (content, ETag, Last-Modified)
+SERVED_IMAGES = {}
+SERVED_IMAGES_LOCK = threading.Lock()
+
+
+# Loads the given outputs into SERVED_IMAGES, swapping each one in whole so readers never see a partial image
+def publish_outputs(output_files):
+    for output_file in output_files:
+        if not os.path.exists(output_file):
+            continue
+        with open(output_file, 'rb') as rendered:
+            content = rendered.read()
+        from email.utils import formatdate
+        etag = f'"{hashlib.sha256(content).hexdigest()[:32]}"'
+        with SERVED_IMAGES_LOCK:
+            SERVED_IMAGES['/' + path.basename(output_file)] = (content, etag, formatdate(time.time(), usegmt=True))
+        print("Serving ", output_file)
+
+
+# Serves the rendered images from memory, while a background thread keeps them up to date with run_daemon
+# Requests are only ever answered from memory, so any number of clients never trigger a render
+def run_server(interval=None, bind_address=None, port=None):
+    import mimetypes
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class ServedImageHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_image(include_body=True)
+
+        def do_HEAD(self):
+            self.send_image(include_body=False)
+
+        def send_image(self, include_body):
+            request_path = self.path.split('?', 1)[0]
+            with SERVED_IMAGES_LOCK:
+                served = SERVED_IMAGES.get(request_path)
+                names = sorted(SERVED_IMAGES)
+            if request_path == '/':
+                body = json.dumps(names).encode('UTF-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if include_body:
+                    self.wfile.write(body)
+                return
+            if served is None:
+                self.send_error(404)
+                return
+            content, etag, last_modified = served
+            if etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Cache-Control', f'public, max-age={serveMaxAge}')
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', mimetypes.guess_type(request_path)[0] or 'application/octet-stream')
+            self.send_header('Content-Length', str(len(content)))
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', last_modified)
+            self.send_header('Cache-Control', f'public, max-age={serveMaxAge}')
+            self.end_headers()
+            if include_body:
+                self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    publish_outputs(get_output_files())
+    refresher = threading.Thread(target=run_daemon, args=(interval, publish_outputs), daemon=True)
+    refresher.start()
+    server = ThreadingHTTPServer((bind_address or serveBindAddress, port or servePort), ServedImageHandler)
+    print(f"Serving cone maps on http://{server.server_address[0]}:{server.server_address[1]}/")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+# Archived advisory products, e.g. AL052023_026adv_CONE.kmz or AL052023_CONE_026.kmz, as (storm, advisory, product)
+ARCHIVE_PRODUCT_PATTERN = re.compile(r'([A-Za-z]{2}\d{6})_(?:(\w+?)_)?(CONE|TRACK)(?:_(\w+))?\.kmz$', re.IGNORECASE)
+# UTC offsets of the time zones the advisories are issued in
+ADVISORY_TIME_ZONES = {'UTC': 0, 'GMT': 0, 'AST': -4, 'EDT': -4, 'EST': -5, 'CDT': -5, 'CST': -6, 'MDT': -6,
+                       'MST': -7, 'PDT': -7, 'PST': -8, 'HDT': -9, 'HST': -10}
+
+
+# Parses an advisoryDate value, e.g. "500 PM AST Tue Aug 29 2023" or "0300 UTC WED AUG 30 2023", into a UTC datetime
+# Returns None if it isn't in that form
+def parse_advisory_date(text):
+    m = re.match(r'\s*(\d{1,2}):?(\d{2})\s*(AM|PM)?\s+([A-Z]{3})\s+\w+\s+(\w{3})\s+(\d{1,2})\s+(\d{4})', text,
+                 re.IGNORECASE)
+    if not m or m.group(4).upper() not in ADVISORY_TIME_ZONES:
+        return None
+    hour = int(m.group(1))
+    if m.group(3):
+        hour = hour % 12 + (12 if m.group(3).upper() == 'PM' else 0)
+    try:
+        local_date = datetime.datetime.strptime(f"{m.group(5)} {m.group(6)} {m.group(7)}", "%b %d %Y")
+        local_time = local_date.replace(hour=hour, minute=int(m.group(2)))
+    except ValueError:
+        return None
+    utc_time = local_time - datetime.timedelta(hours=ADVISORY_TIME_ZONES[m.group(4).upper()])
+    return utc_time.replace(tzinfo=datetime.timezone.utc)
 
-        # Now convert kmz to kml
-        for file in glob.glob("*.kmz"):
-            kmz_to_kml(file)
 
-        if generateAtlantic:
-            do_mod_atl_image()
-        if generateEasternPacific:
-            do_mod_east_pac_image()
-        if generateCentralPacific:
-            do_mod_cpac_image()
+# The advisory time of a KMZ product (file name or file object), from its advisoryDate ExtendedData if it has one,
+# otherwise from the timestamp of its KML member (taken as UTC)
+# Returns None if neither is there
+def read_kmz_advisory_time(kmz_source):
+    with zipfile.ZipFile(kmz_source, 'r') as zf:
+        for info in zf.infolist():
+            if not info.filename.endswith('.kml'):
+                continue
+            data_name = None
+            with zf.open(info) as kml_stream:
+                for event, elem in ET.iterparse(kml_stream, events=('start', 'end')):
+                    tag = elem.tag.rsplit('}', 1)[-1]
+                    if event == 'start':
+                        if tag == 'Data':
+                            data_name = elem.get('name')
+                        continue
+                    if tag == 'value' and data_name == 'advisoryDate':
+                        advisory_time = parse_advisory_date(elem.text or '')
+                        if advisory_time is not None:
+                            return advisory_time
+                    # The coordinates come after the ExtendedData, so a cone never has to be read in full
+                    elif tag in ('coordinates', 'Placemark'):
+                        break
+                    elem.clear()
+            if info.date_time[0] > 1980:
+                return datetime.datetime(*info.date_time, tzinfo=datetime.timezone.utc)
+    return None
 
-        # Clean up
-        if cleanUpFiles:
-            for file in glob.glob("*.km*"):
-                os.remove(file)
-            try:
-                os.remove("two_atl_7d0.png")
-            except:
-                pass
-            try:
-                os.remove("two_pac_7d0.png")
-            except:
-                pass
-            try:
-                os.remove("two_cpac_7d0.png")
-            except:
-                pass
+
+# Lists the CONE/TRACK products in an archive directory (searched recursively) or zip file
+# Yields (storm, advisory, product, ref), where ref is the file path, or the member name for a zip
+def list_archive_products(archive_path):
+    if path.isdir(archive_path):
+        refs = glob.glob(path.join(archive_path, '**', '*.kmz'), recursive=True)
+    else:
+        with zipfile.ZipFile(archive_path, 'r') as archive:
+            refs = [name for name in archive.namelist() if name.lower().endswith('.kmz')]
+    for ref in sorted(refs):
+        m = ARCHIVE_PRODUCT_PATTERN.search(path.basename(ref))
+        if not m:
+            continue
+        storm, prefix, product, suffix = m.groups()
+        advisory = (prefix or suffix or '').lower().replace('adv', '')
+        yield storm.upper(), advisory, product.upper(), ref
+
+
+# Groups an archive's products by storm advisory, and reads each advisory's time, preferring its TRACK's advisoryDate
+# Returns a list of (advisory time, storm, {product: ref}) sorted by time, the time rounded to the hour so storms
+# advising in the same cycle from different time zones line up
+def get_archive_advisories(archive_path):
+    advisories = {}
+    for storm, advisory, product, ref in list_archive_products(archive_path):
+        advisories.setdefault((storm, advisory), {})[product] = ref
+    archive = None if path.isdir(archive_path) else zipfile.ZipFile(archive_path, 'r')
+    dated = []
+    try:
+        for (storm, advisory), products in advisories.items():
+            advisory_time = None
+            for product in ('TRACK', 'CONE'):
+                if product not in products or advisory_time is not None:
+                    continue
+                ref = products[product]
+                advisory_time = read_kmz_advisory_time(ref if archive is None else io.BytesIO(archive.read(ref)))
+                if advisory_time is None and archive is None:
+                    advisory_time = datetime.datetime.fromtimestamp(os.path.getmtime(ref), datetime.timezone.utc)
+            if advisory_time is None:
+                print(f"WARNING: No advisory time for {storm} advisory {advisory}, skipping it")
+                continue
+            advisory_time = (advisory_time + datetime.timedelta(minutes=30)).replace(minute=0, second=0,
+                                                                                     microsecond=0)
+            dated.append((advisory_time, storm, products))
+    finally:
+        if archive is not None:
+            archive.close()
+    return sorted(dated, key=lambda entry: (entry[0], entry[1]))
+
+
+# Works out what each map shows: one entry per advisory time, as (time, [(storm, product, ref)]), with every storm's
+# latest advisory up to that time, as long as it's no more than max_age hours old
+def get_archive_schedule(advisories, max_age=None):
+    max_age = datetime.timedelta(hours=archiveMaxAdvisoryAge if max_age is None else max_age)
+    latest = {}
+    schedule = []
+    for index, (advisory_time, storm, products) in enumerate(advisories):
+        latest[storm] = (advisory_time, products)
+        if index + 1 < len(advisories) and advisories[index + 1][0] == advisory_time:
+            continue
+        shown = [(storm_id, product, ref) for storm_id, (storm_time, storm_products) in sorted(latest.items())
+                 if advisory_time - storm_time <= max_age for product, ref in sorted(storm_products.items())]
+        schedule.append((advisory_time, shown))
+    return schedule
+
+
+# The file a basin's map for one advisory time is written to, e.g. archive_output/atl_latest_20230829_2100Z.png
+def get_archive_output_file(basin, output_dir, advisory_time):
+    stem, ext = path.splitext(path.basename(basin['output_file']))
+    return path.join(output_dir, f"{stem}_{advisory_time:%Y%m%d_%H%M}Z{ext}")
+
+
+# Renders every basin for a run of consecutive advisory times, in a worker process
+# Products in a zip archive are extracted to a scratch directory for the advisory being rendered, and consecutive
+# times share their parsed storms through build_storm_cache_from_products, so each task holds one advisory at a time
+# Returns the files written, and the worker's metrics
+def render_archive_chunk(archive_path, chunk, output_dir, basins):
+    import tempfile
+    reset_run_metrics()
+    written = []
+    archive = None if path.isdir(archive_path) else zipfile.ZipFile(archive_path, 'r')
+    try:
+        for advisory_time, shown in chunk:
+            with tempfile.TemporaryDirectory(prefix='nhc-cones-archive-') as scratch_dir:
+                products = []
+                for index, (storm, product, ref) in enumerate(shown):
+                    if archive is not None:
+                        local_file = path.join(scratch_dir, f"{index}_{storm}_{product}.kmz")
+                        with open(local_file, 'wb') as out:
+                            out.write(archive.read(ref))
+                        ref = local_file
+                    products.append((storm, product, ref))
+                with timed_stage('parse'):
+                    storm_cache = build_storm_cache_from_products(products)
+            for basin in basins:
+                archive_basin = dict(basin, output_file=get_archive_output_file(basin, output_dir, advisory_time),
+                                     loop=False)
+                with timed_stage('render', basin=basin['name']):
+                    if render_basin(archive_basin, storm_cache, advisory_time):
+                        written += get_basin_output_files(archive_basin)
+    finally:
+        if archive is not None:
+            archive.close()
+    return written, RUN_METRICS
+
+
+# Renders every basin for every advisory time in an archive directory or zip of CONE/TRACK kmz files
+# The current base images are used for every map, and maps already rendered from the same inputs are skipped,
+# so an interrupted run can be restarted
+# At most two chunks per worker are queued at a time, so memory stays flat however long the archive is
+# Returns the files written
+def run_archive(archive_path, output_dir=None):
+    output_dir = output_dir or archiveOutputDir
+    os.makedirs(output_dir, exist_ok=True)
+    basins = get_basins()
+    base_image_urls = [url for url, file in dict.fromkeys((basin['base_image_url'], basin['base_image_file'])
+                                                          for basin in basins) if not os.path.exists(file)]
+    start_fetch_deadline()
+    with timed_stage('fetch'):
+        fetch_files(base_image_urls)
+    with timed_stage('index'):
+        schedule = get_archive_schedule(get_archive_advisories(archive_path))
+    print(f"Rendering {len(schedule)} advisory times for {len(basins)} basins")
+    written = []
+    max_workers = archiveMaxWorkers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=apply_worker_settings,
+                             initargs=(get_worker_settings(),)) as executor:
+        pending = set()
+        for start in range(0, len(schedule), archiveChunkSize):
+            if len(pending) >= max_workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    chunk_written, worker_metrics = future.result()
+                    merge_run_metrics(worker_metrics)
+                    written += chunk_written
+            chunk = schedule[start:start + archiveChunkSize]
+            pending.add(executor.submit(render_archive_chunk, archive_path, chunk, output_dir, basins))
+        for future in as_completed(pending):
+            chunk_written, worker_metrics = future.result()
+            merge_run_metrics(worker_metrics)
+            written += chunk_written
+    increment_counter('outputs_regenerated', len(written))
+    if cleanUpFiles:
+        for base_image_url in base_image_urls:
+            os.remove(path.basename(urlparse(base_image_url).path))
+    return written
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description='Plots the NHC forecast cones onto the 7 day outlook graphics')
+    parser.add_argument('--daemon', action='store_true', help='Stay resident and poll the NHC on a schedule')
+    parser.add_argument('--serve', action='store_true',
+                        help='Poll like --daemon, and serve the latest images over HTTP from memory')
+    parser.add_argument('--interval', type=float, default=daemonPollInterval,
+                        help=f'Seconds between polls in daemon and serve mode (default {daemonPollInterval})')
+    parser.add_argument('--port', type=int, default=servePort, help=f'Port for serve mode (default {servePort})')
+    parser.add_argument('--bind', default=serveBindAddress,
+                        help=f'Address for serve mode to listen on (default {serveBindAddress})')
+    parser.add_argument('--archive', metavar='PATH',
+                        help='Render one map per basin per advisory from a directory or zip of archived kmz files')
+    parser.add_argument('--output-dir', default=archiveOutputDir,
+                        help=f'Where archive mode writes its maps (default {archiveOutputDir})')
+    args = parser.parse_args()
+    if args.archive:
+        reset_run_metrics()
+        with timed_stage('total'):
+            archive_outputs = run_archive(args.archive, args.output_dir)
+        print(f"Wrote {len(archive_outputs)} files to {args.output_dir}")
+        write_metrics_report()
+    elif args.serve:
+        try:
+            run_server(args.interval, args.bind, args.port)
+        except KeyboardInterrupt:
+            pass
+    elif args.daemon:
+        try:
+            run_daemon(args.interval)
+        except KeyboardInterrupt:
+            pass
+    else:
+        main()